@@ -1,27 +1,127 @@
 import pandas as pd
 import numpy as np
 import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
 import config
+import session_calendar
 
-def read_data(folder_path):
+
+# Bump this whenever the layout of the cached files changes, so that old caches are rebuilt
+CACHE_VERSION = 2
+
+# Columns stored as float32 in the cache when this is lossless (prices on the tick grid, integer volumes < 2**24),
+# float64 otherwise. Volumes stay floats because they are nan at limit up/down.
+FLOAT32_COLUMNS = ['LastPrice'] + [f'{side}{kind}{i}' for side in ['Bid', 'Ask'] for kind in ['Price', 'Volume'] for i in range(1, 6)]
+
+# Columns needed by the pipeline itself, independently of the factors:
+# index construction, the fills in clean_l2_data, remove_limit (all 10 prices) and the label
+BASE_COLUMNS = ['TradingDay', 'UpdateTime', 'UpdateMillisec', 'y_pos', 'Volume', 'BidVolume1', 'AskVolume1'] + \
+               [f'BidPrice{i}' for i in range(1, 6)] + [f'AskPrice{i}' for i in range(1, 6)]
+
+
+def read_data(folder_path, columns=None, files=None):
     """
         Read all the csv's in the folder, concat together
+        Each csv is parsed only once into a parquet file in config.cache_dir, later runs load the cached parquet files.
     :param folder_path:
+    :param columns: only load these columns, None for all columns
+    :param files: only load these csv file names (e.g. ['20230303.csv']), None for all csv's in the folder
     :return: all data
     """
-    files = os.listdir(folder_path)
-    dataframes = []
-    # Iterate through the list of filenames, filter out the CSV files, and read the
-    for file in files:
-        if file.endswith('.csv'):
-            file_path = os.path.join(folder_path, file)
-            df = pd.read_csv(file_path)
-            dataframes.append(df)
+    cache_paths = build_cache(folder_path, files=files)
+    dataframes = [pd.read_parquet(cache_path, columns=columns) for cache_path in cache_paths]
     # concat merges all DataFrames
     combined_df = pd.concat(dataframes, ignore_index=True)
     return combined_df
 
 
+def build_cache(folder_path, files=None, cache_dir=None, n_jobs=None):
+    """
+        Parse the csv's that are missing from the cache (or whose cache is stale) in a process pool.
+        The cache file name contains a hash of the csv path, size and mtime, so editing or replacing a csv
+        invalidates its cache automatically.
+    :param folder_path:
+    :param files: csv file names to cache, None for all csv's in the folder
+    :param cache_dir: defaults to config.cache_dir. Each data folder has its own sub-folder, so the csv's of
+                      different products with the same name (the trading day) never replace each other's cache
+    :param n_jobs: number of worker processes, defaults to config.n_jobs (None means all cores, 1 means serial)
+    :return: list of cache file paths, in the (sorted) order of the csv's
+    """
+    cache_dir = config.cache_dir if cache_dir is None else cache_dir
+    cache_dir = os.path.join(cache_dir, os.path.basename(os.path.abspath(folder_path)))
+    n_jobs = config.n_jobs if n_jobs is None else n_jobs
+    if files is None:
+        files = [file for file in os.listdir(folder_path) if file.endswith('.csv')]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    cache_paths = []
+    missing = []
+    for file in sorted(files):
+        file_path = os.path.join(folder_path, file)
+        cache_path = cache_file(file_path, cache_dir)
+        cache_paths.append(cache_path)
+        if not os.path.exists(cache_path):
+            missing.append((file_path, cache_path))
+
+    if n_jobs == 1 or len(missing) == 1:
+        for file_path, cache_path in missing:
+            _parse_csv(file_path, cache_path)
+    elif missing:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # list() so that exceptions raised in the workers are propagated
+            list(executor.map(_parse_csv, *zip(*missing)))
+    return cache_paths
+
+
+def compact_dtypes(df):
+    """
+        Downcast the columns of FLOAT32_COLUMNS to float32 where no value changes, and UpdateMillisec to int16
+    :param df: raw data of one csv
+    :return: df
+    """
+    for col in FLOAT32_COLUMNS:
+        if col in df.columns:
+            values = df[col].to_numpy(dtype=np.float64)
+            compact = values.astype(np.float32)
+            if np.array_equal(compact, values, equal_nan=True):
+                df[col] = compact
+    if 'UpdateMillisec' in df.columns and df['UpdateMillisec'].notna().all():
+        df['UpdateMillisec'] = df['UpdateMillisec'].astype(np.int16)
+    return df
+
+
+def cache_file(file_path, cache_dir):
+    """
+        Path of the cache file of a csv, keyed on the csv's absolute path, size and mtime
+    """
+    stat = os.stat(file_path)
+    key = f'{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|{CACHE_VERSION}'
+    digest = hashlib.md5(key.encode()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(cache_dir, f'{name}_{digest}.parquet')
+
+
+def _parse_csv(file_path, cache_path):
+    """
+        Parse one csv into its parquet cache file, and delete the stale cache files of the same csv
+    """
+    df = pd.read_csv(file_path, dtype={'TradingDay': str, 'UpdateTime': str})
+    df = compact_dtypes(df)
+    # Write to a temporary file first so that an interrupted run never leaves a broken cache file
+    tmp_path = cache_path + '.tmp'
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+
+    cache_dir, cache_name = os.path.split(cache_path)
+    prefix = cache_name[:cache_name.rindex('_') + 1]
+    for old_name in os.listdir(cache_dir):
+        if old_name.startswith(prefix) and len(old_name) == len(cache_name) and old_name != cache_name:
+            os.remove(os.path.join(cache_dir, old_name))
+    return cache_path
+
+
 def clean_l2_data(l2):
     """
         Usage:
@@ -30,110 +130,225 @@ def clean_l2_data(l2):
     :param l2: level2数据
     :return: 处理后的数据
     """
-    l2['UpdateMillisec_str'] = l2['UpdateMillisec'].astype(str).str.zfill(3)
-    # Merge the time string and the milliseconds string to create a new indexed column
-    l2['combined_index'] = l2['UpdateTime'] + '.' + l2['UpdateMillisec_str']
-    # Set 'combined_index' to index and convert to datetime type
-    l2.set_index('combined_index', inplace=True)
-    l2.index = pd.to_datetime(l2.index)
+    # The index is built arithmetically from the date, time and milliseconds, without parsing strings into datetimes
+    l2.index = build_index(l2)
 
     # drop some useless columns
-    l2.drop(columns=['InstrumentID', 'UpdateMillisec','ExchangeID', 'time_sec', 'temp2'] ,inplace=True)
+    l2.drop(columns=['InstrumentID', 'UpdateTime', 'UpdateMillisec','ExchangeID', 'time_sec', 'temp2'] ,inplace=True, errors='ignore')
+    l2['TradingDay'] = l2['TradingDay'].astype('category')
     # Prevent multiple csv's from being out of order when concatting
-    l2_sorted = l2.sort_index()
+    l2_sorted = l2 if l2.index.is_monotonic_increasing else l2.sort_index()
 
     # When volume is 0, Lastprice is empty; just fill in the missing values.
-    l2_sorted['Volume'] = l2_sorted['Volume'].fillna(method='bfill')
-
-    # It's just filled with nan so that the calculation doesn't report an error, it doesn't affect the actual factor value.
-    l2_sorted['BidVolume1'] = l2_sorted['BidVolume1'].fillna(method='bfill')
-    l2_sorted['AskVolume1'] = l2_sorted['AskVolume1'].fillna(method='bfill')
-    l2_sorted['BidPrice1'] = l2_sorted['BidPrice1'].fillna(method='bfill')
-    l2_sorted['AskPrice1'] = l2_sorted['AskPrice1'].fillna(method='bfill')
+    # The volumes and prices of level 1 are just filled with nan so that the calculation doesn't report an error,
+    # it doesn't affect the actual factor value.
+    fill_columns = ['Volume', 'BidVolume1', 'AskVolume1', 'BidPrice1', 'AskPrice1']
+    l2_sorted[fill_columns] = l2_sorted[fill_columns].bfill()
 
     return l2_sorted
 
 
-def factor_time_range(index, n1, n2):
+def build_index(l2):
+    """
+        DatetimeIndex from UpdateTime ('HH:MM:SS' or 'YYYY-MM-DD HH:MM:SS'), UpdateMillisec and TradingDay.
+        The digits of UpdateTime are read from its bytes and combined with integer arithmetic.
+        If UpdateTime has no date, the date is the TradingDay, and the day before for the night session (>= 18:00).
+    :param l2: raw data
+    :return: DatetimeIndex
+    """
+    update_time = l2['UpdateTime'].to_numpy().astype('S')
+    width = update_time.dtype.itemsize
+    digits = np.frombuffer(update_time.tobytes(), dtype=np.uint8).reshape(len(update_time), width).astype(np.int64)
+    if width not in (8, 19) or (digits == 0).any():
+        # Not a fixed width format, fall back to parsing the strings
+        combined = l2['UpdateTime'] + '.' + l2['UpdateMillisec'].astype(str).str.zfill(3)
+        return pd.DatetimeIndex(pd.to_datetime(combined.to_numpy()))
+    digits -= ord('0')
+
+    def number(start, stop):
+        value = np.zeros(len(digits), dtype=np.int64)
+        for i in range(start, stop):
+            value = value * 10 + digits[:, i]
+        return value
+
+    offset = width - 8
+    seconds = number(offset, offset + 2) * 3600 + number(offset + 3, offset + 5) * 60 + number(offset + 6, offset + 8)
+    if width == 19:
+        days = _days_from_civil(number(0, 4), number(5, 7), number(8, 10))
+    else:
+        codes, trading_days = pd.factorize(l2['TradingDay'].astype(str))
+        days = pd.to_datetime(trading_days).asi8[codes] // (86400 * 10 ** 9)
+        days = days - (seconds >= 18 * 3600)
+    nanoseconds = (days * 86400 + seconds) * 10 ** 9 + l2['UpdateMillisec'].to_numpy(dtype=np.int64) * 10 ** 6
+    return pd.DatetimeIndex(nanoseconds.view('M8[ns]'))
+
+
+def _days_from_civil(year, month, day):
+    """
+        Days since 1970-01-01 of (year, month, day) arrays, for the proleptic Gregorian calendar
+    """
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+def trading_days(data):
+    """
+        Row ranges of the trading days of the (sorted) data
+    :param data: cleaned data, with the TradingDay column
+    :return: list of (trading day, start position, end position)
+    """
+    day_values = data['TradingDay'].to_numpy()
+    if len(day_values) == 0:
+        return []
+    # Positions where the trading day changes
+    starts = np.flatnonzero(day_values[1:] != day_values[:-1]) + 1
+    starts = np.concatenate([[0], starts])
+    ends = np.concatenate([starts[1:], [len(day_values)]])
+    return [(str(day_values[start]), start, end) for start, end in zip(starts, ends)]
+
+
+def trading_day_of(index, data):
+    """
+        Trading day of each element of index (a subset of the index of data, e.g. the factor index)
+    :param index:
+    :param data: cleaned data (sorted), with the TradingDay column
+    :return: array of trading days
+    """
+    positions = data.index.searchsorted(index)
+    return data['TradingDay'].to_numpy()[positions]
+
+
+def factor_time_range(index, n1, n2, product=None, open_minutes=None, divide_time_range=None):
     """
         Range of index for filter factor calculation
+        The trading sessions of each product are defined in session_calendar.py, the masks are built with integer
+        comparisons on the nanoseconds since midnight.
     :param index: index of the data, in datetime format
     :param n1: the number of seconds before the opening of the market to be eliminated,
                 e.g. n1=30 seconds for the opening of the market to be eliminated
     :param n2: the number of seconds after the close of the market to be culled,
                 e.g., n2=10 seconds for the open.
+    :param product: SHFE product code, defaults to config.product
+    :param open_minutes: defaults to config.open_minutes
+    :param divide_time_range: defaults to config.divide_time_range
     :return: the culled indexes, which can be used to calculate the factors
     """
-    # night
-    night_start = '21:00:00'
-    night_end = '01:00:00'         # todo：For different underlying, the night market closes at different times
-    # morning 1
-    morning_start = '09:00:00'
-    morning_end = '10:15:00'
-    # morning 2
-    late_morning_start = '10:30:00'
-    late_morning_end = '11:30:00'
-    # afternoon
-    afternoon_start = '13:30:00'
-    afternoon_end = '15:00:00'
-
-    # Define the n-second timedelta object
-    n_seconds = pd.to_timedelta(f'{n1} seconds')
-    n2_seconds = pd.to_timedelta(f'{n2} seconds')
-    n3_seconds = pd.to_timedelta(f'{config.open_minutes} seconds')
-
-    # Construct filters Retain the index that satisfies the condition,
+    product = config.product if product is None else product
+    open_minutes = config.open_minutes if open_minutes is None else open_minutes
+    divide_time_range = config.divide_time_range if divide_time_range is None else divide_time_range
+    tod = session_calendar.time_of_day(index)
+
+    # Retain the index that satisfies the condition,
     # i.e., retain: n1 seconds from the opening of the market to n2 seconds before the closing of the market
-    conditions_to_keep = (
-            ((index.time >= (pd.to_datetime(night_start) + n_seconds).time()) |     # todo: note here: if the night close is after 24:00, the last symbol is |; if the close is before 24:00, it is &
-             (index.time <= (pd.to_datetime(night_end) - n2_seconds).time())) |
-            ((index.time >= (pd.to_datetime(morning_start) + n_seconds).time()) &
-             (index.time <= (pd.to_datetime(morning_end) - n2_seconds).time())) |
-            ((index.time >= (pd.to_datetime(late_morning_start) + n_seconds).time()) &
-             (index.time <= (pd.to_datetime(late_morning_end) - n2_seconds).time())) |
-            ((index.time >= (pd.to_datetime(afternoon_start) + n_seconds).time()) &
-             (index.time <= (pd.to_datetime(afternoon_end) - n2_seconds).time()))
-    )
-    # Apply filters
-    index_filtered = index[conditions_to_keep]
+    conditions_to_keep = session_calendar.in_intervals(tod, session_calendar.trading_boundaries(product, n1, n2))
 
-    if config.divide_time_range:
+    if divide_time_range:
         # Only keep the opening minutes
-        conditions_to_keep1 = (
-                ((index.time <= (pd.to_datetime(night_start) + n3_seconds).time()) &
-                 (index.time >= pd.to_datetime(night_start).time())) |
-                ((index.time <= (pd.to_datetime(morning_start) + n3_seconds).time()) &
-                 (index.time >= (pd.to_datetime(morning_start)).time())) |
-                ((index.time <= (pd.to_datetime(afternoon_start) + n3_seconds).time()) &
-                 (index.time >= (pd.to_datetime(afternoon_start)).time())))
-
-        index_filtered = index[conditions_to_keep1 & conditions_to_keep]
+        conditions_to_keep &= session_calendar.in_intervals(
+            tod, session_calendar.opening_boundaries(product, open_minutes))
 
+    # Apply filters
+    index_filtered = index[conditions_to_keep]
     return index_filtered
 
 
-def pretreat_factor(value0, data):
+def pretreat_factor(value0, data, params=None):
     """
         Factor processing
         First, set all the factor values within the stopping range to nan, because it is impossible to open a position at this time, and need to be eliminated.
         Then calculate the mean and variance after removing inf and nan, and then replace inf and nan with the mean;
         Then standardize the factors
-    :param factor_df:
-    :return:
+        All the factors are processed at once as a 2-D array (ticks x factors), in place.
+    :param value0: factor values along with y, as returned by get_alpha
+    :param data: cleaned data, for the limit up/down ticks
+    :param params: statistics fitted on a training window by fit_pretreatment, applied out of sample.
+                   None to fit them on value0 itself.
+    :return: the processed factor values along with y
     """
-    value = value0.copy(deep=True)
-
-    # Remove up and down stops in the training and test sets
-    value = remove_limit(value, data)
-
-    # standardization
-    value = standardize(value)
+    factor_columns = value0.columns.difference(['y'])
+    # The only copy of the factor values
+    matrix = value0[factor_columns].to_numpy(dtype=np.float64, copy=True)
+
+    # Remove up and down stops in the training and test sets, nan and inf are handled together below
+    matrix[limit_mask(value0.index, data)] = np.nan
+    matrix[~np.isfinite(matrix)] = np.nan
+
+    if params is None:
+        params = _fit(matrix, factor_columns)
+    params = params[factor_columns]
+    mean, std = params.loc['mean'].to_numpy(), params.loc['std'].to_numpy()
+
+    # Fill the values of nan and inf with mean, then standardization
+    np.copyto(matrix, np.broadcast_to(mean, matrix.shape), where=np.isnan(matrix))
+    matrix -= mean
+    matrix /= std
     # MAD depolarization (not enabled)
     if config.extreme_value:
-        value = extreme_process_MAD(value)
+        median, mad = params.loc['median'].to_numpy(), params.loc['MAD'].to_numpy()
+        np.clip(matrix, median - 3 * 1.4826 * mad, median + 3 * 1.4826 * mad, out=matrix)
+
+    value = pd.DataFrame(matrix, index=value0.index, columns=factor_columns)
+    if 'y' in value0.columns:
+        value['y'] = value0['y']
     return value
 
 
+def fit_pretreatment(value0, data):
+    """
+        Fit the statistics used by pretreat_factor on a training window, to apply them out of sample, e.g.
+        params = fit_pretreatment(factor.loc[:'2023-06-30'], data)
+        factor = pretreat_factor(factor, data, params)
+    :param value0: factor values of the training window, as returned by get_alpha
+    :param data: cleaned data, for the limit up/down ticks
+    :return: dataframe with rows mean, std (after removing limit up/down, nan and inf), median, MAD (of the
+             standardized factors, if config.extreme_value) and one column per factor
+    """
+    factor_columns = value0.columns.difference(['y'])
+    matrix = value0[factor_columns].to_numpy(dtype=np.float64, copy=True)
+    matrix[limit_mask(value0.index, data)] = np.nan
+    matrix[~np.isfinite(matrix)] = np.nan
+    return _fit(matrix, factor_columns)
+
+
+def _fit(matrix, factor_columns):
+    """
+        mean / std / median / MAD of each column of the factor matrix, nan being the removed values.
+        matrix is left unchanged.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Calculate mean and std after deleting nan and inf
+        mean = np.nanmean(matrix, axis=0)
+        std = np.nanstd(matrix, axis=0, ddof=1)
+        median = np.full(len(factor_columns), np.nan)
+        mad = np.full(len(factor_columns), np.nan)
+        if config.extreme_value:
+            # Median and MAD of the standardized factors (removed values count as the mean, i.e. 0)
+            standardized = np.where(np.isnan(matrix), 0, (matrix - mean) / std)
+            median = np.median(standardized, axis=0)
+            mad = np.median(np.abs(standardized - median), axis=0)
+    return pd.DataFrame([mean, std, median, mad], index=['mean', 'std', 'median', 'MAD'], columns=factor_columns)
+
+
+def limit_mask(index, data):
+    """
+        Find the time points for up and down stops: out of the 10 prices, as long as one of them is 0 or empty
+        it is considered as an up or down stop
+    :param index: index of the factor values
+    :param data: cleaned data
+    :return: boolean array, True for the elements of index that are up or down stop time points of data
+    """
+    price_columns = [col for col in data.columns if col.startswith('BidPrice') or col.startswith('AskPrice')]
+    prices = data[price_columns].to_numpy()
+    # Computed once as a row mask over all the prices
+    combined_condition = ((prices == 0) | np.isnan(prices)).any(axis=1)
+    time_points = data.index[combined_condition]
+    return index.isin(time_points)
+
+
 def standardize(value):
     """
         Setting the factor values of nan and inf to mean and then normalizing the factor values.
@@ -141,33 +356,22 @@ def standardize(value):
     :return:
     """
     factor_stock = value.columns.difference(['y'])
-    for stock in factor_stock:
-        x = value[stock]
-
-        # Calculate mean and std after deleting nan and inf
-        finite_values = x[np.isfinite(x)]
-        values = finite_values.dropna()
-        mean = values.mean()
-        std = values.std()
-
-        # Fill the values of nan and inf with mean
-        x = x.fillna(mean)
-        x = x.replace([np.inf, -np.inf], mean)
-
-        value[stock] = (x - mean)/std
+    matrix = value[factor_stock].to_numpy(dtype=np.float64, copy=True)
+    matrix[~np.isfinite(matrix)] = np.nan
+    params = _fit(matrix, factor_stock)
+    mean, std = params.loc['mean'].to_numpy(), params.loc['std'].to_numpy()
+    np.copyto(matrix, np.broadcast_to(mean, matrix.shape), where=np.isnan(matrix))
+    value[factor_stock] = (matrix - mean) / std
     return value
 
 
 # Median to extremes, using MAD
 def extreme_process_MAD(value):
     factor_stock = value.columns.difference(['y'])
-    for stock in factor_stock:
-        x = value[stock]
-        median = x.median()
-        MAD = abs(x - median).median()
-        x[x>(median+3*1.4826*MAD)] = median+3*1.4826*MAD
-        x[x<(median-3*1.4826*MAD)] = median-3*1.4826*MAD
-        value[stock] = x
+    matrix = value[factor_stock].to_numpy(dtype=np.float64, copy=True)
+    median = np.median(matrix, axis=0)
+    MAD = np.median(np.abs(matrix - median), axis=0)
+    value[factor_stock] = np.clip(matrix, median - 3 * 1.4826 * MAD, median + 3 * 1.4826 * MAD)
     return value
 
 
@@ -178,26 +382,8 @@ def remove_limit(factor_df, data0):
     :param data0:
     :return:
     """
-    data = data0.copy()
     factor_column = factor_df.columns.difference(['y'])
-    # Screening for up and down stops
-    # time_points = data[(data['BidPrice1'] == 0) | (data['BidPrice1'] == np.nan) | (data['AskPrice1'] == np.nan) | (data['AskPrice1'] == 0)].index
-    # Out of 10 price, as long as one of them is empty it will be considered as an up or down stop
-    bid_cols = [col for col in data.columns if col.startswith('BidPrice')]
-    ask_cols = [col for col in data.columns if col.startswith('AskPrice')]
-    conditions = [(data[col] == 0) | (data[col].isna()) for col in bid_cols + ask_cols]
-    combined_condition = np.any(conditions, axis=0)
-    time_points = data[combined_condition].index
-
-    matching_indices = time_points.intersection(factor_df.index)
     # set to nan. nan will be handled subsequently
-    factor_df.loc[matching_indices, factor_column] = np.nan
+    factor_df.loc[limit_mask(factor_df.index, data0), factor_column] = np.nan
 
     return factor_df
-
-
-
-
-
-
-
@@ -0,0 +1,211 @@
+import numpy as np
+import pandas as pd
+import config
+import performance_analysis
+import session_calendar
+
+
+def holding_windows(data, positions, holding, unit='seconds', product=None):
+    """
+        Tradable ticks of the data and the holding window of a position opened at each of the positions.
+        A tick is tradable when both BidPrice1 and AskPrice1 are quoted (no limit price) inside a trading session.
+        The window of a position opened at a tick ends `holding` ticks later, or at the first tick at or after
+        t + holding seconds, moved to the next tradable tick, and at the latest at the last tradable tick of the
+        session: positions are always flat at the end of a session.
+    :param data: cleaned data (sorted), with BidPrice1 and AskPrice1
+    :param positions: row positions (in data) of the factor ticks
+    :param holding: holding period
+    :param unit: 'ticks' or 'seconds'
+    :param product: SHFE product code, defaults to config.product
+    :return: bid and ask of the tradable ticks, and for each position the tradable tick it trades at (-1 if the tick
+             is not tradable) and the tradable tick closing its window
+    """
+    product = config.product if product is None else product
+    bid = data['BidPrice1'].to_numpy(dtype=np.float64)
+    ask = data['AskPrice1'].to_numpy(dtype=np.float64)
+    session = session_calendar.session_ids(data.index, product)
+    tradable = np.flatnonzero((bid > 0) & (ask > 0) & (session >= 0))
+    if len(tradable) == 0:
+        return bid[tradable], ask[tradable], np.full(len(positions), -1), np.full(len(positions), -1)
+
+    # Rank of each position among the tradable ticks, -1 if it is not one of them
+    ranks = np.minimum(np.searchsorted(tradable, positions), len(tradable) - 1)
+    entries = np.where(tradable[ranks] == positions, ranks, -1)
+
+    if unit == 'ticks':
+        ends = positions + int(holding)
+    else:
+        timestamps = data.index.asi8
+        target = timestamps[positions] + int(round(holding * session_calendar.NS_PER_SECOND))
+        ends = np.searchsorted(timestamps, target, side='left')
+    exits = np.searchsorted(tradable, ends, side='left')
+    # Last tradable tick of the session of every tradable tick
+    tradable_session = session[tradable]
+    session_last = np.flatnonzero(np.append(tradable_session[1:] != tradable_session[:-1], True))
+    last = np.repeat(session_last, np.diff(np.concatenate([[-1], session_last])))
+    exits = np.where(entries >= 0, np.minimum(exits, last[np.maximum(entries, 0)]), -1)
+    return bid[tradable], ask[tradable], entries, exits
+
+
+def round_trips(signal, entries, exits):
+    """
+        Round trips of the position series of a signal. Every non-zero signal sets the position to its sign
+        (one contract, long or short) for its holding window: a later signal cuts the window short (closing or
+        flipping the position, or extending it if it has the same sign), the position is closed at the end of the
+        window otherwise. The position of every tick is that of the last signal whose window it is in, so it comes
+        from the signals and the ends of their windows alone, with no loop over the ticks.
+    :param signal: -1, 0 or 1 at every factor tick (in time order)
+    :param entries: see holding_windows
+    :param exits: see holding_windows
+    :return: entry tick, exit tick (tradable tick ranks) and side (1 long, -1 short) of every round trip
+    """
+    triggers = np.flatnonzero((signal != 0) & (entries >= 0))
+    starts, ends = entries[triggers], exits[triggers]
+    sides = np.where(ends > starts, signal[triggers], 0)
+    # After each signal, the position drops to 0 at the end of its window if the next signal comes later
+    next_starts = np.append(starts[1:], np.iinfo(np.int64).max)
+    closes = (ends > starts) & (ends < next_starts)
+
+    # Position changes in time order: (tick, new position) of each signal followed by its close, if any
+    ticks = np.column_stack([starts, ends]).ravel()
+    new_positions = np.column_stack([sides, np.zeros_like(sides)]).ravel()
+    keep = np.column_stack([np.ones(len(starts), dtype=bool), closes]).ravel()
+    ticks, new_positions = ticks[keep], new_positions[keep]
+    previous = np.concatenate([[0], new_positions[:-1]])
+    changes = new_positions != previous
+
+    # Positions are opened and closed alternately, the k-th opening ends with the k-th closing
+    opened = changes & (new_positions != 0)
+    closed = changes & (previous != 0)
+    return ticks[opened], ticks[closed], new_positions[opened]
+
+
+def trade_stats(starts, ends, sides, bid, ask, fee=0.0, fee_rate=0.0):
+    """
+        Returns of round trips filled at BidPrice1 / AskPrice1, in bp of the entry mid price
+    :param starts: see round_trips
+    :param ends:
+    :param sides:
+    :param bid: see holding_windows
+    :param ask:
+    :param fee: fee per contract and per side, in price units
+    :param fee_rate: fee per side, as a fraction of the traded price
+    :return: net and gross mid-to-mid return of every round trip
+    """
+    long = sides > 0
+    entry_price = np.where(long, ask[starts], bid[starts])
+    exit_price = np.where(long, bid[ends], ask[ends])
+    mid = (bid[starts] + ask[starts]) / 2
+    net = (sides * (exit_price - entry_price) - 2 * fee - fee_rate * (entry_price + exit_price)) / mid * 10000
+    gross = sides * ((bid[ends] + ask[ends]) / 2 / mid - 1) * 10000
+    return net, gross
+
+
+def backtest_factor(values, bid, ask, entries, exits, levels, trigger='threshold', direction=1, fee=0.0, fee_rate=0.0):
+    """
+        Backtest of one factor for several trigger levels.
+        Beyond the trigger the factor signals a long position on the high side and a short one on the low side
+        (flipped by `direction`), held as a position series (see round_trips): at most one contract at a time, so the
+        fills, turnover and drawdown are those of a single tradable position.
+    :param values: (standardized) factor values at the factor ticks
+    :param bid: see holding_windows
+    :param ask:
+    :param entries:
+    :param exits:
+    :param levels: trigger levels
+    :param trigger: 'threshold': signal when factor >= level or factor <= -level (level > 0),
+                    'quantile': signal on the `level` share of the ticks with the highest and with the lowest factor
+                    values (level < 0.5, ticks tied with the cut value signal as well)
+    :param direction: 1 to buy on high factor values, -1 to sell
+    :param fee: see trade_stats
+    :param fee_rate:
+    :return: dataframe, one row per level
+    """
+    levels = list(levels)
+    finite = values[np.isfinite(values)]
+    # Cut values of the high and low side of every level
+    if trigger == 'quantile':
+        ks = [int(np.floor(level * len(finite))) for level in levels]
+        kth = sorted({k - 1 for k in ks if k > 0} | {len(finite) - k for k in ks if k > 0})
+        partitioned = np.partition(finite, kth) if kth else finite
+        high_cuts = [partitioned[len(finite) - k] if k > 0 else np.inf for k in ks]
+        low_cuts = [partitioned[k - 1] if k > 0 else -np.inf for k in ks]
+    else:
+        high_cuts = list(levels)
+        low_cuts = [-level for level in levels]
+
+    rows = []
+    for level, high_cut, low_cut in zip(levels, high_cuts, low_cuts):
+        with np.errstate(invalid='ignore'):
+            signal = np.where(values >= high_cut, direction, np.where(values <= low_cut, -direction, 0))
+        starts, ends, sides = round_trips(signal, entries, exits)
+        net, gross = trade_stats(starts, ends, sides, bid, ask, fee=fee, fee_rate=fee_rate)
+        trades = len(net)
+
+        # Equity curve of the level, trades booked when closed (they do not overlap)
+        equity = np.cumsum(net)
+        drawdown = np.max(np.maximum.accumulate(np.concatenate([[0], equity]))[1:] - equity) if trades else 0.0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rows.append({'level': level,
+                         'trades': trades,
+                         'long_trades': int((sides > 0).sum()),
+                         'pnl': net.sum(),
+                         'pnl_per_trade': net.sum() / trades,
+                         'gross_per_trade': gross.sum() / trades,
+                         'cost_per_trade': (gross.sum() - net.sum()) / trades,
+                         'win_rate': (net > 0).sum() / trades,
+                         'max_drawdown': drawdown,
+                         # Share of the tradable ticks with an open position
+                         'exposure': (ends - starts).sum() / len(bid)})
+    return pd.DataFrame(rows)
+
+
+def run(factor_values, data, levels=None, trigger=None, holding=None, unit=None, fee=None, fee_rate=None, product=None):
+    """
+        Backtest of every factor: PnL (bp of the entry mid price, after spread and fees), turnover, win rate and
+        drawdown of its position series for each trigger level. All the factors share the holding windows computed
+        by holding_windows.
+    :param factor_values: processed factor values along with y, as returned by pretreat_factor
+    :param data: cleaned data, with BidPrice1 / AskPrice1 of every tick (also the ticks outside of the factor index)
+    :param levels: defaults to config.backtest_levels
+    :param trigger: defaults to config.backtest_trigger
+    :param holding: defaults to config.backtest_holding
+    :param unit: defaults to config.backtest_unit
+    :param fee: defaults to config.fee
+    :param fee_rate: defaults to config.fee_rate
+    :param product: defaults to config.product
+    :return: dataframe indexed by factor and level
+    """
+    levels = config.backtest_levels if levels is None else levels
+    trigger = config.backtest_trigger if trigger is None else trigger
+    holding = config.backtest_holding if holding is None else holding
+    unit = config.backtest_unit if unit is None else unit
+    fee = config.fee if fee is None else fee
+    fee_rate = config.fee_rate if fee_rate is None else fee_rate
+
+    # Row of each factor tick in data (both indexes are sorted)
+    positions = np.searchsorted(data.index.asi8, factor_values.index.asi8)
+    bid, ask, entries, exits = holding_windows(data, positions, holding, unit=unit, product=product)
+    n_days = data['TradingDay'].iloc[positions].nunique()
+
+    tables = {}
+    for factor in factor_values.columns.difference(['y']):
+        values = factor_values[factor].to_numpy(dtype=np.float64)
+        # Trade in the direction of the IC
+        ic = factor_values[factor].corr(factor_values['y'])
+        table = backtest_factor(values, bid, ask, entries, exits, levels, trigger=trigger,
+                                direction=-1 if ic < 0 else 1, fee=fee, fee_rate=fee_rate)
+        # Contracts bought and sold per day, a flip trades two contracts but closes one round trip and opens the next
+        table['turnover_per_day'] = 2 * table['trades'] / n_days
+        tables[factor] = table.set_index('level')
+    return pd.concat(tables, names=['Factor', 'level'])
+
+
+def write_backtest(table, n):
+    """
+        Output the backtest table to backtest.csv
+    :param table: dataframe returned by run
+    :param n: number of ticks, to tell the test data from the total data
+    """
+    table.to_csv(performance_analysis.output_path('backtest.csv', n))
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import config
+import Data_Process
+import factors
+import performance_analysis
+import synthetic_data
+
+
+# Synthetic data sizes: number of trading days and snapshots per second
+SCALES = {
+    'small': {'days': 1, 'ticks_per_second': 2},
+    'medium': {'days': 5, 'ticks_per_second': 2},
+    'large': {'days': 20, 'ticks_per_second': 2},
+}
+
+RESULTS_DIR = 'benchmark_results'
+
+
+def run_stages(folder_path, factor_list, run_dir, trace_memory=False):
+    """
+        Run every stage of main_demo once on the csv's of folder_path
+    :param folder_path:
+    :param factor_list:
+    :param run_dir: new folder, working directory of the run with an empty parquet cache (so that the first read
+                    parses the csv's) and an empty result folder (so that output renders every factor)
+    :param trace_memory: record the peak memory allocated by each stage (tracemalloc, slows the stages down)
+    :return: dict stage -> {'seconds': wall time, 'peak_bytes': peak allocated memory or None}
+    """
+    results = {}
+
+    def measure(stage, func, *args, **kwargs):
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        results[stage] = {'seconds': seconds, 'peak_bytes': peak}
+        return value
+
+    columns = Data_Process.BASE_COLUMNS + [col for col in factors.required_columns(factor_list) if col not in Data_Process.BASE_COLUMNS]
+    os.makedirs(os.path.join(run_dir, 'result'))
+    os.makedirs(os.path.join(run_dir, 'result_test'))
+    os.chdir(run_dir)
+    config.cache_dir = 'cache'
+    measure('read_data (parse)', Data_Process.build_cache, folder_path)
+    l2 = measure('read_data (cached)', Data_Process.read_data, folder_path, columns=columns)
+    data = measure('clean_l2_data', Data_Process.clean_l2_data, l2)
+    factor_index = measure('factor_time_range', Data_Process.factor_time_range, data.index, n1=config.n1, n2=config.n2)
+    factor = measure('get_alpha', factors.get_alpha, data, factor_index, factor_list)
+    factor = measure('pretreat_factor', Data_Process.pretreat_factor, factor, data)
+    covariance = measure('IC_quantile', performance_analysis.IC_quantile, factor)
+    # output() only plots the total data (200000 ticks and more), the charts are rendered whatever the scale
+    measure('output', performance_analysis.render_factors, factor, covariance.correlation()['y'])
+    return results
+
+
+def benchmark(scales, factor_list, trace_memory=True):
+    """
+        Generate the synthetic data of each scale and time (and memory-profile) every stage on it.
+        Runs in a temporary folder, with the factor store disabled so that get_alpha really computes the factors.
+    :return: dict scale -> dict stage -> {'seconds', 'peak_bytes'}
+    """
+    results = {}
+    cwd = os.getcwd()
+    factor_store, n_jobs, cache_dir = config.factor_store, config.n_jobs, config.cache_dir
+    config.factor_store = None
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for scale in scales:
+                folder_path = os.path.join(work_dir, scale, 'raw_data')
+                synthetic_data.generate(folder_path, days=SCALES[scale]['days'],
+                                        ticks_per_second=SCALES[scale]['ticks_per_second'])
+                timings = run_stages(folder_path, factor_list, os.path.join(work_dir, scale, 'time'))
+                if trace_memory:
+                    # tracemalloc only sees this process: no worker processes in the memory run
+                    config.n_jobs = 1
+                    memory = run_stages(folder_path, factor_list, os.path.join(work_dir, scale, 'memory'),
+                                        trace_memory=True)
+                    config.n_jobs = n_jobs
+                    for stage in timings:
+                        timings[stage]['peak_bytes'] = memory[stage]['peak_bytes']
+                results[scale] = timings
+                print(f'{scale}: ' + ', '.join(f'{stage} {values["seconds"]:.3f}s' for stage, values in timings.items()))
+    finally:
+        os.chdir(cwd)
+        config.factor_store, config.n_jobs, config.cache_dir = factor_store, n_jobs, cache_dir
+    return results
+
+
+def compare(results, baseline, tolerance=0.25, min_seconds=0.05, min_bytes=2 ** 20):
+    """
+        Regressions of results against a baseline: stages slower (or using more memory) than the baseline by more
+        than `tolerance`, ignoring differences below min_seconds / min_bytes (noise)
+    :return: list of messages
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for stage, values in stages.items():
+            reference = baseline.get(scale, {}).get(stage)
+            if reference is None:
+                continue
+            seconds, reference_seconds = values['seconds'], reference['seconds']
+            if seconds > reference_seconds * (1 + tolerance) and seconds - reference_seconds > min_seconds:
+                regressions.append(f'{scale} / {stage}: {seconds:.3f}s vs {reference_seconds:.3f}s in the baseline')
+            peak, reference_peak = values.get('peak_bytes'), reference.get('peak_bytes')
+            if peak is not None and reference_peak is not None and \
+                    peak > reference_peak * (1 + tolerance) and peak - reference_peak > min_bytes:
+                regressions.append(f'{scale} / {stage}: {peak / 2 ** 20:.1f} MB vs {reference_peak / 2 ** 20:.1f} MB in the baseline')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory-profile every stage of the pipeline on synthetic data')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=list(SCALES))
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    results = benchmark(args.scales, config.factor_list, trace_memory=not args.no_memory)
+    if not os.path.exists(RESULTS_DIR):
+        os.makedirs(RESULTS_DIR)
+    with open(os.path.join(RESULTS_DIR, 'results.json'), 'w') as file:
+        json.dump(results, file, indent=2)
+
+    baseline_path = os.path.join(RESULTS_DIR, 'baseline.json')
+    if args.save_baseline:
+        with open(baseline_path, 'w') as file:
+            json.dump(results, file, indent=2)
+    elif os.path.exists(baseline_path):
+        with open(baseline_path) as file:
+            regressions = compare(results, json.load(file), tolerance=args.tolerance)
+        for message in regressions:
+            print(f'REGRESSION {message}')
+        if regressions:
+            sys.exit(1)
@@ -8,10 +8,21 @@
 
 factor_list = ['imbalance', 'z']
 
+product = 'ss'    # SHFE product code, selects the trading sessions in session_calendar.py
+
+# Per-product settings of multi-product runs (python scheduler.py): data folder, and n1 / n2 / open_minutes /
+# divide_time_range below if they differ for the product. The trading sessions come from session_calendar.py
+products = {
+    'ss': {'data_path': 'ss_raw_data'},
+}
+product_list = ['ss']   # Products evaluated by scheduler.py
+
 
 
 usage = "all"     # 'test' or 'all'，one day test or total data
 
+streaming = False  # Process one trading day at a time to keep the memory bounded (only IC / corr / head and tail stats are output)
+
 
 
 
@@ -28,4 +39,65 @@ open_minutes = 1000 # If testing only for a period of time after the opening, ho
 # I set this up to test if the factor had different results during the opening hours, as the market tends to be more active during those times.
 # Later testing revealed little difference
 
-extreme_value = False   # Whether to depolarize the factors
\ No newline at end of file
+extreme_value = False   # Whether to depolarize the factors
+
+corr_threshold = 0.7   # Pairs of factors with abs(corr) above this are listed in Correlation_pairs.csv, and clustered together
+
+# Greedy forward selection of a subset of factors by incremental IC (IC of the part of a factor orthogonal to the factors
+# already selected), skipping factors with abs(corr) above corr_threshold with a selected one. Output to factor_selection.csv
+factor_selection = False
+selection_min_ic = 0.002   # Stop when the best incremental IC is below this
+
+pretreat_fit_end = None  # e.g. '2023-06-30': fit the mean/std/median/MAD of the factors up to this date and apply them out of sample
+
+# Forward mid-price returns used for the IC decay table (IC_decay.csv), [] to disable. They never cross a session
+label_horizons = [1, 3, 5, 10, 30, 60]
+label_unit = 'seconds'   # 'seconds' or 'ticks'
+
+html_report = False   # Also write result/report.html, one self-contained file with the performance table and all the figures
+
+# Backtest of the factor signals with fills at BidPrice1 / AskPrice1, output to backtest.csv
+backtest = False
+backtest_trigger = 'threshold'   # 'threshold': trade when abs(factor) >= level (in std), 'quantile': trade the top / bottom `level` share of the ticks
+backtest_levels = [1, 1.5, 2, 2.5, 3, 4]
+backtest_holding = 5   # Holding period of a position after the last signal, never crossing a session
+backtest_unit = 'seconds'   # 'seconds' or 'ticks'
+fee = 0.0        # Fee per contract and per side, in price units
+fee_rate = 0.0   # Fee per side, as a fraction of the traded price
+
+
+
+
+# Parsed csv's are cached as parquet files here, delete the folder to force a re-parse
+cache_dir = 'cache'
+
+# Raw factor values are stored per factor and trading day here, and only recomputed when the factor or the data changes.
+# None to recompute all the factors on every run
+factor_store = 'factor_store'
+
+n_jobs = None   # Number of worker processes used for parsing and factor calculation, None means all cores, 1 means serial
+
+# Factors are computed day by day. Warm windowed factors (e.g. rolling(n)) up with the last ticks of the previous day,
+# as declared by their lookback; False resets them at the start of each day
+factor_warmup = True
+
+# Record the wall time, CPU time and peak RSS of each stage and each factor; written to result/instrumentation.json and
+# result/trace.json (open in chrome://tracing or ui.perfetto.dev) with a summary printed at the end of the run
+instrument = False
+instrument_memory = False   # Also record the peak allocations of each stage with tracemalloc (slows the run down)
+
+
+def product_settings(product):
+    """
+        Settings of a product: products[product] completed with the global settings above
+    :param product: SHFE product code
+    :return: dict with product, data_path, n1, n2, open_minutes and divide_time_range
+    """
+    settings = {'product': product,
+                'data_path': f'{product}_raw_data',
+                'n1': n1,
+                'n2': n2,
+                'open_minutes': open_minutes,
+                'divide_time_range': divide_time_range}
+    settings.update(products.get(product, {}))
+    return settings
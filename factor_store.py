@@ -0,0 +1,69 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+
+
+class FactorStore:
+    """
+        Persistent store of raw (not pretreated) factor values, one .npy file per factor and trading day:
+        <root>/<factor>/<TradingDay>_<key>.npy
+        The key is a hash of the factor's source code and parameters plus a fingerprint of the input data of that day,
+        so editing a factor (or its intermediates) or the data makes the entries stale, and they are recomputed.
+        Entries are loaded memory-mapped.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def key(self, source, params, fingerprint):
+        """
+            Key of an entry
+        :param source: source code of the factor and of the intermediates it uses
+        :param params: parameters of the factor
+        :param fingerprint: data_fingerprint of the input columns of the factor on that trading day
+        :return: hex string
+        """
+        digest = hashlib.md5()
+        digest.update(source.encode())
+        digest.update(repr(sorted(params.items())).encode())
+        digest.update(fingerprint.encode())
+        return digest.hexdigest()[:16]
+
+    def path(self, name, day, key):
+        return os.path.join(self.root, name, f'{day}_{key}.npy')
+
+    def load(self, name, day, key):
+        """
+            Memory-mapped factor values of one day, None if missing or stale
+        """
+        path = self.path(name, day, key)
+        if not os.path.exists(path):
+            return None
+        return np.load(path, mmap_mode='r')
+
+    def save(self, name, day, key, values):
+        """
+            Save the factor values of one day and delete the stale entries of the same factor and day
+        """
+        path = self.path(name, day, key)
+        factor_dir, file_name = os.path.split(path)
+        if not os.path.exists(factor_dir):
+            os.makedirs(factor_dir)
+        # Write to a temporary file first so that an interrupted run never leaves a broken entry
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, np.asarray(values, dtype=np.float64))
+        os.replace(tmp_path, path)
+
+        prefix = f'{day}_'
+        for old_name in os.listdir(factor_dir):
+            if old_name.startswith(prefix) and len(old_name) == len(file_name) and old_name != file_name:
+                os.remove(os.path.join(factor_dir, old_name))
+
+
+def data_fingerprint(data, columns):
+    """
+        Hash of the index and of the given columns of the data
+    """
+    hashes = pd.util.hash_pandas_object(data[list(columns)], index=True).values
+    return hashlib.md5(hashes.tobytes()).hexdigest()
@@ -1,29 +1,161 @@
 import pandas as pd
 import numpy as np
+import inspect
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import config
+import Data_Process
+import factor_store
+import instrumentation
+import performance_analysis
+import shared_book
 import statsmodels.api as sm
 from scipy.stats import skew, kurtosis
 
-def get_alpha(data, factor_index, factor_list):
+
+# name -> FactorSpec, filled by the @factor decorator
+FACTORS = {}
+# name -> IntermediateSpec, filled by the @intermediate decorator
+INTERMEDIATES = {}
+
+
+@dataclass
+class FactorSpec:
+    """
+        A registered factor
+    :param func: func(ctx, **params) -> factor value series
+    :param inputs: raw data columns and/or intermediates read by the factor
+    :param params: default parameters passed to func
+    :param lookback: number of previous ticks the factor needs (e.g. n - 1 for rolling(n)), int or func(**params) -> int
+    """
+    name: str
+    func: object
+    inputs: tuple
+    params: dict = field(default_factory=dict)
+    lookback: object = 0
+
+    def compute(self, ctx, **params):
+        return self.func(ctx, **{**self.params, **params})
+
+    def lookback_ticks(self, **params):
+        if callable(self.lookback):
+            return self.lookback(**{**self.params, **params})
+        return self.lookback
+
+
+@dataclass
+class IntermediateSpec:
+    """
+        A registered intermediate shared by the factors, computed at most once per FactorContext
+    :param func: func(ctx) -> series
+    :param inputs: raw data columns and/or other intermediates read by func
+    """
+    name: str
+    func: object
+    inputs: tuple
+
+
+def factor(inputs, lookback=0, **params):
+    """
+        Decorator registering a factor in FACTORS, e.g.
+        @factor(inputs=['mid', 'LastPrice'])
+        def my_alpha(ctx): ...
+    :param inputs: raw data columns and/or intermediates read by the factor
+    :param lookback: see FactorSpec
+    :param params: default parameters
+    """
+    def register(func):
+        FACTORS[func.__name__] = FactorSpec(func.__name__, func, tuple(inputs), params, lookback)
+        return func
+    return register
+
+
+def intermediate(inputs):
+    """
+        Decorator registering an intermediate in INTERMEDIATES
+    :param inputs: raw data columns and/or other intermediates read by the intermediate
+    """
+    def register(func):
+        INTERMEDIATES[func.__name__] = IntermediateSpec(func.__name__, func, tuple(inputs))
+        return func
+    return register
+
+
+class FactorContext:
+    """
+        What the factors see of the data: ctx['BidPrice1'] is a read-only float64 view of a column (no copy),
+        ctx['mid'] an intermediate, computed on first access and then shared by all the factors of the run.
+        ctx.rolling_mean('mid', n) is a rolling mean of a column / intermediate; the rolling means of all windows
+        come from one cumulative sum, computed on first access.
+        The data is a dataframe, or a mapping column -> array (e.g. views of a shared_book) along with the index.
+    """
+
+    def __init__(self, data, index=None):
+        self.data = data
+        self.index = data.index if index is None else index
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name not in self._cache:
+            if name in INTERMEDIATES:
+                self._cache[name] = INTERMEDIATES[name].func(self)
+            else:
+                self._cache[name] = self._column(name)
+        return self._cache[name]
+
+    def rolling_mean(self, name, n):
+        """
+            Same as ctx[name].rolling(n).mean(): nan for the first n - 1 ticks and for windows holding nan or inf
+        :param name: column or intermediate
+        :param n: window, in ticks
+        :return: series
+        """
+        key = ('cumsum', name)
+        if key not in self._cache:
+            values = np.asarray(self[name], dtype=np.float64)
+            finite = np.isfinite(values)
+            # Running sum of the finite values and running count of the others, with a leading 0
+            total = np.zeros(len(values) + 1)
+            np.cumsum(np.where(finite, values, 0), out=total[1:])
+            non_finite = np.zeros(len(values) + 1, dtype=np.int64)
+            np.cumsum(~finite, out=non_finite[1:])
+            self._cache[key] = total, non_finite
+        total, non_finite = self._cache[key]
+
+        mean = np.full(len(self.index), np.nan)
+        if 0 < n <= len(mean):
+            window_sum = total[n:] - total[:-n]
+            clean = non_finite[n:] == non_finite[:-n]
+            mean[n - 1:] = np.where(clean, window_sum / n, np.nan)
+        return pd.Series(mean, index=self.index, name=name, copy=False)
+
+    def _column(self, name):
+        # float32 columns of the compact cache are converted (once), float64 columns are not copied
+        values = np.asarray(self.data[name], dtype=np.float64).view()
+        values.flags.writeable = False
+        return pd.Series(values, index=self.index, name=name, copy=False)
+
+
+def get_alpha(data, factor_index, factor_list, store=None):
     """
 
     :param data: Processed raw data
     :param factor_index: The remaining index after filtering
     :param factor_list: The list of factors needed to compute the value
+    :param store: FactorStore, only the factors/days missing from the store (or stale) are computed. None to compute all.
     :return:
     """
+    values = compute_alpha(data, factor_list, store=store)
 
-    current = pd.DataFrame()
-    current.index = pd.to_datetime(current.index)
-
+    current = pd.DataFrame(index=data.index)
     for single_factor in factor_list:
         if single_factor not in current.columns:
-            func = globals()[single_factor]
-            value = func(data)
             # Add the factor value to the factor dataset of current
-            current.insert(0, single_factor, value)
+            current.insert(0, single_factor, values[single_factor])
 
     # insert y to the dataframe
-    current['y'] = data['y_pos'].loc[current.index] * 10000 # unit is bp
+    current['y'] = data['y_pos'] * 10000 # unit is bp
 
     # Remove a couple ticks at open and close
     current = current.loc[factor_index]
@@ -36,18 +168,312 @@ def get_alpha(data, factor_index, factor_list):
     return current
 
 
+def compute_alpha(data, factor_list, store=None, n_jobs=None):
+    """
+        Raw factor values of all trading days.
+        Each trading day is computed on its own (in a process pool when n_jobs != 1), preceded by the last `lookback`
+        ticks of the previous day (config.factor_warmup) so that windowed factors see the same history as on the
+        concatenated data. The values match those computed on the concatenated data up to rounding only (running
+        sums start at another tick, ~1e-14), but serial and parallel runs compute exactly the same chunks, so they
+        are bit-identical to each other.
+    :param data: Processed raw data
+    :param factor_list:
+    :param store: FactorStore, the factors/days found in the store are loaded instead of computed. None to compute all.
+    :param n_jobs: number of worker processes, defaults to config.n_jobs (None means all cores, 1 means serial)
+    :return: dict factor name -> array of the factor values, aligned with data
+    """
+    n_jobs = config.n_jobs if n_jobs is None else n_jobs
+    factor_list = list(dict.fromkeys(factor_list))
+    values = {single_factor: np.empty(len(data)) for single_factor in factor_list}
+
+    # Factors with the same lookback share the chunks, and one context per chunk
+    groups = {}
+    for single_factor in factor_list:
+        lookback = FACTORS[single_factor].lookback_ticks() if config.factor_warmup else 0
+        groups.setdefault(lookback, []).append(single_factor)
+    sources = {single_factor: factor_source(single_factor) for single_factor in factor_list}
+    columns = {single_factor: tuple(required_columns([single_factor])) for single_factor in factor_list}
+
+    # (trading day, chunk start, day start, day end, {factor: store key}) of the chunks to compute
+    tasks = []
+    for day, start, end in Data_Process.trading_days(data):
+        for lookback, names in groups.items():
+            chunk_start = max(0, start - lookback)
+            keys = {}
+            fingerprints = {}
+            for single_factor in names:
+                key = None
+                if store is not None:
+                    # Factors reading the same columns share the fingerprint
+                    if columns[single_factor] not in fingerprints:
+                        fingerprints[columns[single_factor]] = factor_store.data_fingerprint(
+                            data.iloc[chunk_start:end], columns[single_factor])
+                    key = store.key(sources[single_factor], FACTORS[single_factor].params,
+                                    fingerprints[columns[single_factor]])
+                    stored = store.load(single_factor, day, key)
+                    if stored is not None:
+                        values[single_factor][start:end] = stored
+                        continue
+                keys[single_factor] = key
+            if keys:
+                tasks.append((day, chunk_start, start, end, keys))
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        chunks = (data.iloc[chunk_start:end][required_columns(list(keys))] for _, chunk_start, _, end, keys in tasks)
+        names = (list(keys) for *_, keys in tasks)
+        offsets = (start - chunk_start for _, chunk_start, start, _, _ in tasks)
+        results = map(compute_chunk, chunks, names, offsets)
+        _collect_chunks(tasks, results, values, store)
+    else:
+        # The columns are published once in shared memory, the workers read views of them and write the factor
+        # values into a shared result matrix: only the descriptors of the two blocks are pickled
+        positions = {single_factor: j for j, single_factor in enumerate(factor_list)}
+        book = shared_book.publish_book(data, required_columns(factor_list))
+        result = shared_book.create_matrix((len(data), len(factor_list)))
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(compute_chunk_shared, book.descriptor, result.descriptor, list(keys),
+                                           positions, chunk_start, start, end)
+                           for _, chunk_start, start, end, keys in tasks]
+                for future in futures:
+                    # The instrumentation events of the workers
+                    instrumentation.merge(future.result())
+            matrix = result.arrays['values']
+            results = ({name: matrix[start:end, positions[name]] for name in keys} for _, _, start, end, keys in tasks)
+            _collect_chunks(tasks, results, values, store)
+            del matrix, results
+        finally:
+            book.close()
+            result.close()
+    return values
+
+
+def sweep(data, factor_index, name, grid, n_jobs=None):
+    """
+        IC / head and tail performance of a factor for every combination of the parameters in grid, e.g.
+        sweep(data, factor_index, 'imbalance', {'n': range(2, 101, 2)})
+        All the parameter sets of a trading day are computed on one context, so the intermediates (and the cumulative
+        sums behind ctx.rolling_mean) are computed once for the whole grid.
+    :param data: Processed raw data
+    :param factor_index: The remaining index after filtering
+    :param name: factor name
+    :param grid: dict parameter -> list of values
+    :param n_jobs: number of worker processes, defaults to config.n_jobs (None means all cores, 1 means serial)
+    :return: dataframe of the IC_quantile metrics of every parameter set (index 'imbalance(n=8)', ...), sorted by abs(IC)
+    """
+    values = sweep_values(data, name, grid, n_jobs=n_jobs)
+    current = pd.DataFrame(values, index=data.index)
+    current['y'] = data['y_pos'] * 10000 # unit is bp
+    current = current.loc[factor_index]
+    current = Data_Process.pretreat_factor(current, data)
+    return performance_analysis.results_table(performance_analysis.factor_metrics(current))
+
+
+def sweep_values(data, name, grid, n_jobs=None):
+    """
+        Raw values of a factor for every combination of the parameters in grid, computed day by day as in compute_alpha
+    :return: dict label ('imbalance(n=8)') -> array of the factor values, aligned with data
+    """
+    n_jobs = config.n_jobs if n_jobs is None else n_jobs
+    param_sets = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    labels = [f"{name}({', '.join(f'{key}={value}' for key, value in params.items())})" for params in param_sets]
+    values = {label: np.empty(len(data)) for label in labels}
+
+    # The chunks are warmed up with the longest lookback of the grid, enough for all parameter sets
+    lookback = max(FACTORS[name].lookback_ticks(**params) for params in param_sets) if config.factor_warmup else 0
+    days = Data_Process.trading_days(data)
+    columns = required_columns([name])
+    if n_jobs == 1 or len(days) <= 1:
+        chunks = (data.iloc[max(0, start - lookback):end][columns] for _, start, end in days)
+        offsets = [start - max(0, start - lookback) for _, start, _ in days]
+        results = map(sweep_chunk, chunks, itertools.repeat(name), itertools.repeat(param_sets), offsets)
+        _collect_sweep(days, labels, results, values)
+    else:
+        # As in compute_alpha, the workers read the columns from shared memory and write into a shared result matrix
+        book = shared_book.publish_book(data, columns)
+        result = shared_book.create_matrix((len(data), len(param_sets)))
+        try:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(sweep_chunk_shared, book.descriptor, result.descriptor, name, param_sets,
+                                           max(0, start - lookback), start, end)
+                           for _, start, end in days]
+                for future in futures:
+                    future.result()
+            matrix = result.arrays['values']
+            results = ([matrix[start:end, j] for j in range(len(param_sets))] for _, start, end in days)
+            _collect_sweep(days, labels, results, values)
+            del matrix, results
+        finally:
+            book.close()
+            result.close()
+    return values
+
+
+def sweep_chunk(chunk, name, param_sets, offset, index=None):
+    """
+        Compute one factor for every parameter set on one chunk, with a single context
+    :param chunk: data of the chunk, dataframe or mapping column -> array
+    :param index: index of the chunk when it is a mapping
+    :return: list of the arrays of the factor values of the day, one per parameter set
+    """
+    ctx = FactorContext(chunk, index=index)
+    return [np.asarray(FACTORS[name].compute(ctx, **params), dtype=np.float64)[offset:] for params in param_sets]
+
+
+def sweep_chunk_shared(book, result, name, param_sets, chunk_start, start, end):
+    """
+        sweep_chunk in the worker processes, on views of the shared book, writing column j of the shared result
+        matrix for parameter set j (see compute_chunk_shared)
+    """
+    columns, index = shared_book.book_slice(shared_book.attach(book), chunk_start, end)
+    matrix = shared_book.attach(result, writeable=True)['values']
+    for j, day_values in enumerate(sweep_chunk(columns, name, param_sets, start - chunk_start, index=index)):
+        matrix[start:end, j] = day_values
+
+
+def _collect_sweep(days, labels, results, values):
+    for (_, start, end), result in zip(days, results):
+        for label, day_values in zip(labels, result):
+            values[label][start:end] = day_values
+
+
+def compute_chunk(chunk, names, offset, index=None):
+    """
+        Compute factors on one chunk (one trading day preceded by its warm-up ticks)
+    :param chunk: data of the chunk, dataframe or mapping column -> array
+    :param names: factors to compute
+    :param offset: number of warm-up ticks at the beginning of the chunk, removed from the output
+    :param index: index of the chunk when it is a mapping
+    :return: dict factor name -> array of the factor values of the day
+    """
+    # Intermediates (mid, depth sums...) are computed once and shared by all the factors
+    ctx = FactorContext(chunk, index=index)
+    # Ticks of the day (len(chunk) is the number of columns when the chunk is a mapping)
+    ticks = len(ctx.index) - offset
+    result = {}
+    for name in names:
+        with instrumentation.stage(name, category='factor', ticks=ticks):
+            result[name] = np.asarray(FACTORS[name].compute(ctx), dtype=np.float64)[offset:]
+    return result
+
+
+def compute_chunk_shared(book, result, names, positions, chunk_start, start, end):
+    """
+        compute_chunk in the worker processes, on views of the shared book, writing into the shared result matrix
+    :param book: descriptor of the shared_book.publish_book of the data
+    :param result: descriptor of the shared_book.create_matrix of the factor values (ticks x factors)
+    :param names: factors to compute
+    :param positions: dict factor name -> column of the result matrix
+    :param chunk_start: first row of the chunk (warm-up ticks included)
+    :param start: first row of the day
+    :param end: end of the day
+    :return: the instrumentation events recorded in the worker
+    """
+    since = len(instrumentation.EVENTS)
+    columns, index = shared_book.book_slice(shared_book.attach(book), chunk_start, end)
+    matrix = shared_book.attach(result, writeable=True)['values']
+    for name, day_values in compute_chunk(columns, names, start - chunk_start, index=index).items():
+        matrix[start:end, positions[name]] = day_values
+    return instrumentation.drain(since)
+
+
+def _collect_chunks(tasks, results, values, store):
+    """
+        Put the results of compute_chunk into values, and into the store
+    """
+    for (day, _, start, end, keys), result in zip(tasks, results):
+        for single_factor, day_values in result.items():
+            values[single_factor][start:end] = day_values
+            if store is not None:
+                store.save(single_factor, day, keys[single_factor], day_values)
+
+
+def factor_source(name):
+    """
+        Source code of a factor, of all the intermediates it uses and of FactorContext (whose helpers, e.g.
+        rolling_mean, compute part of the factors), used to detect changes of the factor
+    """
+    sources = []
+
+    def add(inputs):
+        for input_name in inputs:
+            if input_name in INTERMEDIATES and INTERMEDIATES[input_name].func not in sources:
+                sources.append(INTERMEDIATES[input_name].func)
+                add(INTERMEDIATES[input_name].inputs)
+
+    sources.append(FACTORS[name].func)
+    add(FACTORS[name].inputs)
+    sources.append(FactorContext)
+    return '\n'.join(inspect.getsource(func) for func in sources)
+
+
+def required_columns(factor_list):
+    """
+        Raw data columns needed to compute the factors in factor_list (intermediates are expanded into their inputs),
+        used to load only these columns
+    :param factor_list:
+    :return: list of column names
+    """
+    columns = []
+
+    def add(inputs):
+        for name in inputs:
+            if name in INTERMEDIATES:
+                add(INTERMEDIATES[name].inputs)
+            elif name not in columns:
+                columns.append(name)
+
+    for single_factor in factor_list:
+        add(FACTORS[single_factor].inputs)
+    return columns
+
+
+#################### Shared intermediates ############################
+
+@intermediate(inputs=['BidPrice1', 'AskPrice1'])
+def mid(ctx):
+    return (ctx['BidPrice1'] + ctx['AskPrice1']) / 2
+
+
+@intermediate(inputs=['mid'])
+def log_mid(ctx):
+    return np.log(ctx['mid'])
+
+
+@intermediate(inputs=['log_mid'])
+def log_return(ctx):
+    return ctx['log_mid'].diff()
+
+
+@intermediate(inputs=['BidPrice1', 'AskPrice1'])
+def spread(ctx):
+    return ctx['AskPrice1'] - ctx['BidPrice1']
+
+
+@intermediate(inputs=[f'BidVolume{i}' for i in range(1, 6)])
+def bid_depth(ctx):
+    # nan volumes count as 0, like DataFrame.sum(axis=1)
+    return sum(ctx[f'BidVolume{i}'].fillna(0) for i in range(1, 6))
+
+
+@intermediate(inputs=[f'AskVolume{i}' for i in range(1, 6)])
+def ask_depth(ctx):
+    return sum(ctx[f'AskVolume{i}'].fillna(0) for i in range(1, 6))
+
+
+@intermediate(inputs=['bid_depth', 'ask_depth'])
+def log_depth_ratio(ctx):
+    return np.log(ctx['bid_depth'] / ctx['ask_depth'])
+
+
 #################### Of course I will not upload my alphas on github! :-) ############################
 #################### Here I only put two simple alphas as example  ###################################
 
-def z(data0):
-    data = data0.copy()
-
-    return np.log((data['BidPrice1'] + data['AskPrice1']) / 2) - np.log(data['LastPrice'])
+@factor(inputs=['log_mid', 'LastPrice'])
+def z(ctx):
+    return ctx['log_mid'] - np.log(ctx['LastPrice'])
 
 
-def imbalance(data0, n=8):
-    data = data0.copy()
-    bid_sum_volume = data[['BidVolume1', 'BidVolume2', 'BidVolume3', 'BidVolume4', 'BidVolume5']].sum(axis=1)
-    ask_sum_volume = data[['AskVolume1', 'AskVolume2', 'AskVolume3', 'AskVolume4', 'AskVolume5']].sum(axis=1)
-    imbalance = np.log(bid_sum_volume / ask_sum_volume)
-    return imbalance - imbalance.rolling(n).mean()
\ No newline at end of file
+@factor(inputs=['log_depth_ratio'], lookback=lambda n: n - 1, n=8)
+def imbalance(ctx, n=8):
+    return ctx['log_depth_ratio'] - ctx.rolling_mean('log_depth_ratio', n)
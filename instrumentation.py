@@ -0,0 +1,209 @@
+import contextlib
+import json
+import os
+import time
+import tracemalloc
+import pandas as pd
+import config
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Events recorded in this process: dicts with name, category, pid, start (epoch seconds), wall, cpu, peak_rss,
+# process_peak_rss, alloc, args
+EVENTS = []
+
+# Returned by stage() when the instrumentation is off: entering/exiting it does nothing
+_DISABLED = contextlib.nullcontext()
+
+# Stages currently open in this process, for the peak allocations and peak RSS of nested stages
+_open_stages = []
+
+# Peak RSS of this process seen so far: resetting the peak RSS for a stage also resets ru_maxrss
+_process_peak = 0
+
+
+def stage(name, category='stage', **args):
+    """
+        Context manager recording the wall time, CPU time, peak RSS and (config.instrument_memory) peak allocations
+        of the code inside it (see _Stage), e.g.
+        with instrumentation.stage('clean_l2_data'):
+            data = Data_Process.clean_l2_data(l2)
+        When config.instrument is False it returns a shared no-op context, so it costs nothing.
+    :param name: name of the stage (or factor)
+    :param category: 'stage', 'day', 'factor', ... (Chrome trace category)
+    :param args: extra information stored with the event
+    """
+    if not config.instrument:
+        return _DISABLED
+    return _Stage(name, category, args)
+
+
+class _Stage:
+    """
+        The peak RSS of a stage is the peak of the process while the stage is open: the high-water mark of the
+        process is reset when the stage is entered (Linux), as the tracemalloc peak. Where it cannot be reset,
+        peak_rss is None and only process_peak_rss (the running peak of the process) is recorded.
+    """
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.trace = config.instrument_memory
+        if self.trace:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak of the enclosing stage so far is kept before resetting the peak for this stage
+            if _open_stages:
+                _open_stages[-1].peak = max(_open_stages[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.alloc_start = current
+            self.peak = current
+        if _open_stages:
+            _open_stages[-1].rss_peak = max(_open_stages[-1].rss_peak or 0, peak_rss() or 0)
+        self.rss_peak = peak_rss() if reset_peak_rss() else None
+        _open_stages.append(self)
+        self.start = time.time()
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        _open_stages.pop()
+        rss = None
+        if self.rss_peak is not None:
+            rss = max(self.rss_peak, peak_rss() or 0)
+            if _open_stages:
+                _open_stages[-1].rss_peak = max(_open_stages[-1].rss_peak or 0, rss)
+        alloc = None
+        if self.trace:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            alloc = self.peak - self.alloc_start
+            if _open_stages:
+                _open_stages[-1].peak = max(_open_stages[-1].peak, self.peak)
+            else:
+                tracemalloc.stop()
+        EVENTS.append({'name': self.name, 'category': self.category, 'pid': os.getpid(), 'start': self.start,
+                       'wall': wall, 'cpu': cpu, 'peak_rss': rss, 'process_peak_rss': process_peak_rss(),
+                       'alloc': alloc, 'args': self.args})
+        return False
+
+
+def peak_rss():
+    """
+        High-water mark of the resident set size of this process in bytes, since the last reset_peak_rss
+        (VmHWM, None where /proc is not available)
+    """
+    global _process_peak
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    # kilobytes
+                    peak = int(line.split()[1]) * 1024
+                    _process_peak = max(_process_peak, peak)
+                    return peak
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+        Reset the high-water mark of the resident set size of this process to its current RSS (Linux)
+    :return: False where it cannot be reset
+    """
+    # The peak before the reset is kept in _process_peak
+    peak_rss()
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def process_peak_rss():
+    """
+        Peak resident set size of this process in bytes since it started, across the resets of reset_peak_rss
+        (None where neither /proc nor the resource module is available)
+    """
+    peak = peak_rss()
+    if resource is not None:
+        # kilobytes on Linux
+        peak = max(peak or 0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    return max(peak, _process_peak) if peak is not None else None
+
+
+def drain(since=0):
+    """
+        Remove and return the events recorded in this process from position `since`, used to send the events of
+        worker processes back (forked workers inherit the events of the parent recorded before the fork)
+    """
+    events = EVENTS[since:]
+    del EVENTS[since:]
+    return events
+
+
+def merge(events):
+    """
+        Add events recorded in another process
+    """
+    EVENTS.extend(events)
+
+
+def summary(events=None):
+    """
+        Events aggregated by name, sorted by total wall time
+    :return: dataframe with count, total/max wall time, CPU time, peak RSS during the stage, peak RSS of the process
+             at the end of the stage and peak allocations of each stage
+    """
+    events = EVENTS if events is None else events
+    frame = pd.DataFrame(events, columns=['name', 'category', 'wall', 'cpu', 'peak_rss', 'process_peak_rss', 'alloc'])
+    memory = ['peak_rss', 'process_peak_rss', 'alloc']
+    frame[memory] = frame[memory].astype(float) / 2 ** 20
+    table = frame.groupby(['category', 'name']).agg(
+        count=('wall', 'size'), wall=('wall', 'sum'), max_wall=('wall', 'max'), cpu=('cpu', 'sum'),
+        peak_rss_mb=('peak_rss', 'max'), process_peak_rss_mb=('process_peak_rss', 'max'), alloc_mb=('alloc', 'max'))
+    return table.sort_values('wall', ascending=False)
+
+
+def write_json(path, events=None):
+    events = EVENTS if events is None else events
+    with open(path, 'w') as file:
+        json.dump(events, file, indent=1, default=str)
+
+
+def write_trace(path, events=None):
+    """
+        Chrome trace (chrome://tracing, https://ui.perfetto.dev) of the events, one row per process
+    """
+    events = EVENTS if events is None else events
+    trace = [{'name': event['name'], 'cat': event['category'], 'ph': 'X', 'pid': event['pid'], 'tid': 0,
+              'ts': event['start'] * 1e6, 'dur': event['wall'] * 1e6,
+              'args': {'cpu_s': event['cpu'], 'peak_rss': event['peak_rss'], 'process_peak_rss': event['process_peak_rss'],
+                       'alloc': event['alloc'], **event['args']}}
+             for event in events]
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file, default=str)
+
+
+def report(folder='result'):
+    """
+        Write instrumentation.json and trace.json into folder and print the summary.
+        Does nothing when config.instrument is False.
+    """
+    if not config.instrument:
+        return
+    write_json(os.path.join(folder, 'instrumentation.json'))
+    write_trace(os.path.join(folder, 'trace.json'))
+    with pd.option_context('display.width', 200, 'display.max_rows', 200):
+        print(summary().round(3))
@@ -0,0 +1,91 @@
+import inspect
+import os
+import numpy as np
+import pandas as pd
+import config
+import Data_Process
+import factor_store
+import session_calendar
+
+
+def label_names(horizons, unit):
+    """
+        Column names of the labels, e.g. y_5s for 5 seconds, y_10t for 10 ticks
+    """
+    suffix = 't' if unit == 'ticks' else 's'
+    return [f'y_{horizon}{suffix}' for horizon in horizons]
+
+
+def forward_returns(data, horizons, unit='seconds', product=None):
+    """
+        Forward mid-price returns (bp) for several horizons at once.
+        The exit tick of a horizon h is h ticks later, or the first tick at or after t + h seconds (searchsorted on
+        the timestamps). If it falls in another trading session (or after the end of the data), or if one side of the
+        book is empty (limit price 0) at the entry or at the exit tick, the label is nan.
+    :param data: cleaned data (sorted), with BidPrice1 and AskPrice1
+    :param horizons: list of horizons
+    :param unit: 'ticks' or 'seconds'
+    :param product: SHFE product code, defaults to config.product
+    :return: dataframe of the labels, one column per horizon, same index as data
+    """
+    product = config.product if product is None else product
+    bid = data['BidPrice1'].to_numpy(dtype=np.float64)
+    ask = data['AskPrice1'].to_numpy(dtype=np.float64)
+    mid = (bid + ask) / 2
+    # Both sides quoted, as the tradable ticks of backtest.holding_windows: at a limit price the mid is half a price
+    quoted = (bid > 0) & (ask > 0)
+    session = session_calendar.session_ids(data.index, product)
+    n = len(mid)
+    horizons = np.asarray(horizons)
+
+    # Exit positions of all ticks and horizons, shape (n, number of horizons)
+    if unit == 'ticks':
+        exits = np.arange(n)[:, None] + horizons[None, :].astype(np.int64)
+    else:
+        timestamps = data.index.asi8
+        targets = timestamps[:, None] + np.round(horizons * session_calendar.NS_PER_SECOND).astype(np.int64)[None, :]
+        exits = np.searchsorted(timestamps, targets.ravel(), side='left').reshape(targets.shape)
+
+    valid = exits < n
+    exits = np.minimum(exits, n - 1)
+    # No crossing of the session boundaries, and no label on limit ticks (price 0)
+    valid &= (session[exits] == session[:, None]) & (session[:, None] >= 0)
+    valid &= quoted[:, None] & quoted[exits]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        returns = np.where(valid, (mid[exits] / mid[:, None] - 1) * 10000, np.nan)
+    return pd.DataFrame(returns, index=data.index, columns=label_names(horizons, unit))
+
+
+def get_labels(data, horizons=None, unit=None, product=None, cache_dir=None):
+    """
+        Labels of all trading days, cached per label and day in <cache_dir>/labels/<product> next to the parsed data.
+        Labels never cross a session, so each day is computed on its own.
+    :param data: cleaned data
+    :param horizons: defaults to config.label_horizons
+    :param unit: defaults to config.label_unit
+    :param product: defaults to config.product
+    :param cache_dir: defaults to config.cache_dir
+    :return: dataframe of the labels, one column per horizon, same index as data
+    """
+    horizons = config.label_horizons if horizons is None else horizons
+    unit = config.label_unit if unit is None else unit
+    product = config.product if product is None else product
+    cache_dir = config.cache_dir if cache_dir is None else cache_dir
+    store = factor_store.FactorStore(os.path.join(cache_dir, 'labels', product))
+    names = label_names(horizons, unit)
+    source = inspect.getsource(forward_returns) + inspect.getsource(session_calendar.session_ids)
+
+    values = {name: np.empty(len(data)) for name in names}
+    for day, start, end in Data_Process.trading_days(data):
+        day_data = data.iloc[start:end]
+        fingerprint = factor_store.data_fingerprint(day_data, ['BidPrice1', 'AskPrice1'])
+        key = store.key(source, {'unit': unit, 'product': product}, fingerprint)
+        stored = {name: store.load(name, day, key) for name in names}
+        if any(day_values is None for day_values in stored.values()):
+            day_labels = forward_returns(day_data, horizons, unit=unit, product=product)
+            for name in names:
+                stored[name] = day_labels[name].to_numpy()
+                store.save(name, day, key, stored[name])
+        for name in names:
+            values[name][start:end] = stored[name]
+    return pd.DataFrame(values, index=data.index, columns=names)
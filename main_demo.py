@@ -1,11 +1,17 @@
-import pandas as pd
 import time
+import sys
+import os
 
 
 # Import 3 py files for the modules of data processing, factor generation, and performance analysis respectively
 import Data_Process
 import factors
 import performance_analysis
+import streaming
+import factor_store
+import labels
+import backtest
+import instrumentation
 import config
 
 
@@ -18,14 +24,39 @@ factor_list = config.factor_list
 # month = config.month
 usage = config.usage       # 'test' or 'all', one/two day test or all data
 
-if usage == 'all':
-    # Read all csv's in the folder and concat as total data
-    l2 = Data_Process.read_data('ss_raw_data')
-elif usage == 'test':
-    # Use one/two day of data as a test
-    l2 = pd.read_csv('ss_raw_data/20230303.csv')
-    # l2_2 = pd.read_csv('ss_raw_data/20230306.csv')
-    # l2 = pd.concat([l2_1, l2_2], ignore_index=True)
+# Data folder, n1/n2 and opening window of the product (config.products), see scheduler.py to run several products
+settings = config.product_settings(config.product)
+data_path = settings['data_path']
+
+# Only load the columns needed by the pipeline and by the factors in factor_list
+columns = Data_Process.BASE_COLUMNS + [col for col in factors.required_columns(factor_list) if col not in Data_Process.BASE_COLUMNS]
+
+if config.streaming:
+    # Day by day: each day goes through STEP1-STEP2 below on its own, and only the statistics of STEP3 are accumulated
+    files = ['20230303.csv'] if usage == 'test' else None
+    with instrumentation.stage('streaming.run'):
+        accumulator = streaming.run(data_path, factor_list, columns=columns, files=files)
+    with instrumentation.stage('IC_quantile_streaming'):
+        performance_analysis.IC_quantile_streaming(accumulator)
+    if config.factor_selection:
+        selection = performance_analysis.select_factors(accumulator.covariance, min_ic=config.selection_min_ic,
+                                                        max_corr=config.corr_threshold)
+        performance_analysis.write_selection(selection, accumulator.n)
+    with instrumentation.stage('output_streaming'):
+        performance_analysis.output_streaming(accumulator)
+    instrumentation.report()
+    end_time = time.time()
+    print(f"program runtime：{end_time - start_time} seconds")
+    sys.exit()
+
+with instrumentation.stage('read_data'):
+    if usage == 'all':
+        # Read all csv's in the folder and concat as total data (parsed once, then loaded from the cache)
+        l2 = Data_Process.read_data(data_path, columns=columns)
+    elif usage == 'test':
+        # Use one/two day of data as a test
+        l2 = Data_Process.read_data(data_path, columns=columns, files=['20230303.csv'])
+        # l2 = Data_Process.read_data(data_path, columns=columns, files=['20230303.csv', '20230306.csv'])
 # else:
 #     l2 = Data_Process.read_data('ss_raw_data')
 #     l2 = l2[l2['TradingDay'].str.slice(start=5, stop=7).isin(['04'])]
@@ -34,45 +65,86 @@ elif usage == 'test':
 
 
 # Data processing, mainly removing unneeded columns, and setting the dateframe index
-data= Data_Process.clean_l2_data(l2)
+with instrumentation.stage('clean_l2_data'):
+    data= Data_Process.clean_l2_data(l2)
 # Index range for filtering factor calculation:
 # e.g. exclude the first n seconds of the open and the last n seconds before the close.
 # Timestamps at the beginning of the opening can interfere with the signal during moving averages,
 #  while it may not be possible to place an order at the close time.
-factor_index = Data_Process.factor_time_range(data.index, n1=config.n1, n2=config.n2)  # (n1 n2 can be changed)
+with instrumentation.stage('factor_time_range'):
+    factor_index = Data_Process.factor_time_range(data.index, n1=settings['n1'], n2=settings['n2'],  # (n1 n2 can be changed)
+                                                  product=config.product, open_minutes=settings['open_minutes'],
+                                                  divide_time_range=settings['divide_time_range'])
 
 
 ######################### STEP2: Calculate factor values ###################################
 
 # Call factors.py to get factor values dataframe
-factor = factors.get_alpha(data, factor_index, factor_list)
+# Only the factors/days missing from the factor store (or whose code/data changed) are computed
+store = None if config.factor_store is None else factor_store.FactorStore(os.path.join(config.factor_store, config.product))
+with instrumentation.stage('get_alpha'):
+    factor = factors.get_alpha(data, factor_index, factor_list, store=store)
 
 # Factor processing, including normalization and processing inf,nan
-factor = Data_Process.pretreat_factor(factor, data)
+with instrumentation.stage('pretreat_factor'):
+    if config.pretreat_fit_end is None:
+        factor = Data_Process.pretreat_factor(factor, data)
+    else:
+        # Statistics of the training window, applied to the whole history
+        pretreat_params = Data_Process.fit_pretreatment(factor.loc[:config.pretreat_fit_end], data)
+        factor = Data_Process.pretreat_factor(factor, data, pretreat_params)
 
 
 ######################### STEP3: Factor Analysis ###################################
 
 # Calculate the ic value for each factor, and the corr between the factors.
 # The output is in the results folder
-performance_analysis.IC_quantile(factor)
-# Quartile y-mean plots, statistical distributions for each factor
-# The output is in results/factor folder
+with instrumentation.stage('IC_quantile'):
+    covariance = performance_analysis.IC_quantile(factor, days=Data_Process.trading_day_of(factor.index, data))
+
+# Low-correlation subset of the factors chosen greedily by incremental IC, from the covariance matrix of IC_quantile
+# The output is factor_selection.csv
+if config.factor_selection:
+    with instrumentation.stage('select_factors'):
+        selection = performance_analysis.select_factors(covariance, min_ic=config.selection_min_ic,
+                                                        max_corr=config.corr_threshold)
+        performance_analysis.write_selection(selection, len(factor))
+# Head and tail 1% means (performance table), quartile y-mean plots, statistical distributions for each factor
+# The output is the performance table and the results/factor folder
 
 # ACF plot not enabled yet
-performance_analysis.output(factor)
+with instrumentation.stage('output'):
+    performance_analysis.output(factor, ic_values=covariance.correlation()['y'])
+
+# IC of each factor against forward returns of several horizons (IC decay), output to IC_decay.csv
+if config.label_horizons:
+    with instrumentation.stage('IC_decay'):
+        label_values = labels.get_labels(data)
+        performance_analysis.IC_decay(factor, label_values.loc[factor.index])
+
+# PnL, turnover, win rate and drawdown of the factor signals after the spread and fees, output to backtest.csv
+if config.backtest:
+    with instrumentation.stage('backtest'):
+        backtest_table = backtest.run(factor, data)
+        backtest.write_backtest(backtest_table, len(factor))
 
 
 
 
 ################### STEP4: Storage factor value #####################
-# It would be too cumbersome to calculate all the factors each time, so store all the processed factors.
-if len(data) > 200000:
+# It would be too cumbersome to calculate all the factors each time.
+# With the factor store, the raw factor values are already stored per factor and day by get_alpha;
+# otherwise store all the processed factors.
+if config.factor_store is None and len(data) > 200000:
     # train[factor_columns].to_pickle('train_factors.pkl')
-    factor.to_pickle('factors.pkl')
+    with instrumentation.stage('to_pickle'):
+        factor.to_pickle('factors.pkl')
+
 
 
 
+# Time / CPU / memory of each stage and factor (config.instrument)
+instrumentation.report()
 
 end_time = time.time()
 run_time = end_time - start_time
@@ -0,0 +1,185 @@
+import math
+import time
+import numpy as np
+import pandas as pd
+import config
+import Data_Process
+import factors
+import streaming
+
+
+# name -> class of the online version of the factor in factors.py, filled by the @online decorator
+ONLINE_FACTORS = {}
+
+
+def online(name):
+    """
+        Decorator registering the online (tick by tick) version of the factor `name` of factors.py.
+        The class is built with the parameters of the factor, and update(tick) returns the factor value of the tick.
+    """
+    def register(cls):
+        ONLINE_FACTORS[name] = cls
+        return cls
+    return register
+
+
+class OnlineEngine:
+    """
+        Evaluates factors tick by tick on a live snapshot feed. Each factor keeps O(1) state, so one update costs
+        a few microseconds regardless of the length of the history.
+    """
+
+    def __init__(self, factor_list):
+        self.factor_list = list(factor_list)
+        self.reset()
+
+    def reset(self):
+        """
+            Forget the state of all factors (e.g. at the start of a trading day)
+        """
+        self.factors = {name: ONLINE_FACTORS[name](**factors.FACTORS[name].params) for name in self.factor_list}
+
+    def update(self, tick):
+        """
+        :param tick: one L2 snapshot, any object with the columns as attributes (e.g. a namedtuple)
+        :return: dict factor name -> factor value
+        """
+        return {name: factor.update(tick) for name, factor in self.factors.items()}
+
+
+def _log(x):
+    # Same as np.log: -inf at 0, nan for negative values and nan
+    if x > 0:
+        return math.log(x)
+    if x == 0:
+        return -math.inf
+    return math.nan
+
+
+def _div(a, b):
+    # Same as numpy division: +-inf when dividing by 0, nan for 0 / 0
+    if b != 0:
+        return a / b
+    if a != a or a == 0:
+        return math.nan
+    return math.copysign(math.inf, a)
+
+
+def _volume_sum(tick, side):
+    # nan volumes count as 0, like factors.bid_depth / factors.ask_depth
+    total = 0.0
+    for i in range(1, 6):
+        volume = getattr(tick, f'{side}Volume{i}')
+        if volume == volume:
+            total += volume
+    return total
+
+
+@online('z')
+class OnlineZ:
+
+    def update(self, tick):
+        return _log((tick.BidPrice1 + tick.AskPrice1) / 2) - _log(tick.LastPrice)
+
+
+@online('imbalance')
+class OnlineImbalance:
+    """
+        Ring buffer of the last n log depth ratios and their running sum for the rolling mean.
+        As in pandas rolling, the mean is nan until n values are seen and while the window holds nan/inf.
+    """
+
+    def __init__(self, n=8):
+        self.n = n
+        self.buffer = [0.0] * n
+        self.position = 0
+        self.count = 0
+        self.total = 0.0
+        self.non_finite = 0
+
+    def update(self, tick):
+        x = _log(_div(_volume_sum(tick, 'Bid'), _volume_sum(tick, 'Ask')))
+
+        # Remove the value leaving the window, add the new one
+        if self.count == self.n:
+            old = self.buffer[self.position]
+            if math.isfinite(old):
+                self.total -= old
+            else:
+                self.non_finite -= 1
+        else:
+            self.count += 1
+        if math.isfinite(x):
+            self.total += x
+        else:
+            self.non_finite += 1
+        self.buffer[self.position] = x
+        self.position = (self.position + 1) % self.n
+
+        if self.count < self.n or self.non_finite:
+            return math.nan
+        return x - self.total / self.n
+
+
+def replay(folder_path, factor_list, files=None):
+    """
+        Feed the daily csv's through the online engine, one snapshot at a time.
+        As in factors.compute_alpha, the state is carried over to the next day if config.factor_warmup, reset otherwise.
+    :param folder_path:
+    :param factor_list:
+    :param files: only replay these csv file names, None for all csv's in the folder
+    :return: dataframe of the factor values (index of the cleaned data), and the mean latency of an update in seconds
+    """
+    columns = Data_Process.BASE_COLUMNS + [col for col in factors.required_columns(factor_list) if col not in Data_Process.BASE_COLUMNS]
+    engine = OnlineEngine(factor_list)
+    values = []
+    index = []
+    elapsed = 0.0
+    for l2 in streaming.iter_days(folder_path, columns=columns, files=files):
+        data = Data_Process.clean_l2_data(l2)
+        if not config.factor_warmup:
+            engine.reset()
+        ticks = data[factors.required_columns(factor_list)].astype(np.float64).itertuples(index=False)
+        start = time.perf_counter()
+        values += [engine.update(tick) for tick in ticks]
+        elapsed += time.perf_counter() - start
+        index.append(data.index)
+    index = index[0].append(index[1:]) if index else pd.DatetimeIndex([])
+    latency = elapsed / len(values) if values else math.nan
+    return pd.DataFrame(values, index=index, columns=factor_list), latency
+
+
+def check_parity(folder_path, factor_list, files=None, atol=1e-9):
+    """
+        Compare the online engine with the batch path (factors.compute_alpha) on the daily csv's
+    :param folder_path:
+    :param factor_list:
+    :param files: only use these csv file names, None for all csv's in the folder
+    :param atol: absolute tolerance (the running sums of the online version differ from pandas in the last bits)
+    :return: dataframe with the max absolute difference and the number of mismatches of each factor
+    """
+    online_values, latency = replay(folder_path, factor_list, files=files)
+
+    columns = Data_Process.BASE_COLUMNS + [col for col in factors.required_columns(factor_list) if col not in Data_Process.BASE_COLUMNS]
+    dataframes = [Data_Process.clean_l2_data(l2) for l2 in streaming.iter_days(folder_path, columns=columns, files=files)]
+    data = pd.concat(dataframes)
+    batch_values = factors.compute_alpha(data, factor_list, n_jobs=1)
+
+    results = pd.DataFrame(columns=['max_abs_diff', 'mismatches'])
+    for name in factor_list:
+        online_array = online_values[name].to_numpy()
+        batch_array = batch_values[name]
+        both_finite = np.isfinite(online_array) & np.isfinite(batch_array)
+        diff = np.abs(online_array[both_finite] - batch_array[both_finite])
+        # nan/inf must be at the same places, with the same value
+        mismatches = (~np.isclose(online_array, batch_array, rtol=0, atol=atol, equal_nan=True)).sum()
+        results.loc[name] = [diff.max() if len(diff) else 0.0, mismatches]
+    print(f"online update latency: {latency * 1e6:.2f} us per tick")
+    return results
+
+
+if __name__ == '__main__':
+    # Parity of the online engine with the batch factors on the test day
+    parity = check_parity('ss_raw_data', config.factor_list, files=['20230303.csv'])
+    print(parity)
+    assert (parity['mismatches'] == 0).all(), 'online factors differ from the batch factors'
@@ -1,145 +1,843 @@
+import abc
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')   # no display needed, figures are only saved (also in the worker processes)
 import matplotlib.pyplot as plt
 from statsmodels.graphics.tsaplots import plot_acf
 import os
+import base64
+import hashlib
+import html
+import inspect
+import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import seaborn as sns
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+import config
+import shared_book
 
 
 
-def IC_quantile(factor_values):
+def IC_quantile(factor_values, days=None):
     """
-        Calculate the IC and head and tail means of each factor and output them
+        Calculate the IC of each factor and the corr of the factors and output them
+        (the head and tail means are output by output(), from the same sort of each factor as its charts)
     :param factor_values: a dataframe containing the values of each factor along with the y-values
-    :return: outputs the IC for each factor and the corr of the factors to result
+    :param days: trading day of each row (see Data_Process.trading_day_of), to also output the IC of every day.
+                 None for no daily IC.
+    :return: outputs the IC for each factor and the corr of the factors to result, returns the CovarianceAccumulator
     """
-
-    if len(factor_values) < 200000:  # if it's test data
-        factor_dir = 'result_test/test_performance.csv'
-    else:                            # it's total data
-        factor_dir = 'result/total performance.csv'
-
-    results = pd.DataFrame(columns=['IC', 'Top 1% Mean y', 'Bottom 1% Mean y', 'bottom_win_rate', 'top_win_rate'])
     # Calculate the IC
-    # Calculate the correlation matrix for the entire DataFram
-    correlation_matrix = factor_values.corr()
+    # Calculate the correlation matrix (factors and y) with the covariance accumulator, one day at a time if possible
+    covariance = CovarianceAccumulator()
+    if days is None:
+        covariance.update(factor_values)
+    else:
+        days = np.asarray(days)
+        # Row ranges of the days (the rows are sorted by time)
+        starts = np.concatenate([[0], np.flatnonzero(days[1:] != days[:-1]) + 1])
+        ends = np.concatenate([starts[1:], [len(days)]])
+        for start, end in zip(starts, ends):
+            covariance.update(factor_values.iloc[start:end], label=str(days[start]))
+        write_daily_ic(covariance.daily_ic_frame(), len(factor_values))
+    correlation_matrix = covariance.correlation()
     # Extracting the corr associated with column 'y' (removing 'y' from itself) which is the IC value
     ic_values = correlation_matrix['y'].drop('y')
     # After removing column 'y' and row 'y' from the correlation matrix, the matrix remain is the corr matrix
     factor_correlation_matrix = correlation_matrix.drop('y', axis=0).drop('y', axis=1)
 
+    write_correlation(factor_correlation_matrix)
+
+    # The accumulator is returned for further analyses (residualize, select_factors)
+    return covariance
+
+
+def factor_metrics(factor_values, ic_values=None):
+    """
+        Performance table rows (tail_row) of every factor: IC, head and tail 1% mean y and win rates
+    :param factor_values: a dataframe containing the values of each factor along with the y-values
+    :param ic_values: IC of each factor, None to compute them here
+    :return: list of tail_row
+    """
+    # Get the values of the factors except y
+    factor_columns = factor_values.columns.difference(['y'])
+    if ic_values is None:
+        ic_values = factor_values[factor_columns].corrwith(factor_values['y'])
+    rows = []
+    for factor in factor_columns:
+        # Each factor is sorted once, the 1%/99% quantiles and the y statistics beyond them come from the sorted values
+        engine = SortedFactor(factor_values[factor], factor_values['y'])
+        rows.append(tail_row(factor, ic_values.loc[factor], engine))
+    return rows
+
+
+def tail_row(factor, ic, engine):
+    """
+        Row of the performance table of one factor: IC, head and tail 1% mean y and win rates
+    :param factor: factor name
+    :param ic: IC of the factor
+    :param engine: SortedFactor or QuantileSketch of the factor
+    :return: dict
+    """
+    (bottom_mean, bottom_pos, bottom_neg), (top_mean, top_pos, top_neg) = engine.tail_stats(0.01)
+    # Calculate the percentage greater than zero (win rate)
+    # sign of if correlation(IC) is positive or negative
+    if ic > 0:
+        top_win_rate = top_pos / (top_pos + top_neg)
+        bottom_win_rate = bottom_neg / (bottom_pos + bottom_neg)
+    else:
+        top_win_rate = top_neg / (top_pos + top_neg)
+        bottom_win_rate = bottom_pos / (bottom_pos + bottom_neg)
+    return {'Factor': factor,
+            'IC': ic,
+            'Top 1% Mean y': top_mean,
+            'Bottom 1% Mean y': bottom_mean,
+            'bottom_win_rate': bottom_win_rate,
+            'top_win_rate': top_win_rate}
+
+
+def write_results(rows, n):
+    """
+        Output the performance table, sorted by abs(IC)
+    :param rows: list of tail_row
+    :param n: number of ticks, to tell the test data from the total data
+    :return:
+    """
+    results_table(rows).to_csv(output_path('test_performance.csv', n, total_name='total performance.csv'))
+    return
+
+
+def output_path(name, n, total_name=None):
+    """
+        Path of an output file: in result_test for the test data, in result for the total data
+    :param name: file name
+    :param n: number of ticks, to tell the test data from the total data
+    :param total_name: file name for the total data, if it differs from name
+    :return: path
+    """
+    if n < 200000:  # if it's test data
+        return os.path.join('result_test', name)
+    return os.path.join('result', name if total_name is None else total_name)
+
+
+def results_table(rows):
+    """
+        Performance table of the rows (tail_row), sorted by abs(IC)
+    """
+    results = pd.DataFrame(rows, columns=['Factor', 'IC', 'Top 1% Mean y', 'Bottom 1% Mean y', 'bottom_win_rate', 'top_win_rate'])
+    results = results.set_index('Factor')
+    return results.reindex(results['IC'].abs().sort_values(ascending=False).index)
+
+
+def IC_decay(factor_values, labels):
+    """
+        IC of every factor against the labels of every horizon, computed in one pass of matrix products
+        (each label only over the ticks where it is not nan), output to IC_decay.csv
+    :param factor_values: dataframe of the factor values (and y), as returned by pretreat_factor
+    :param labels: dataframe of the labels, same index as factor_values (see labels.get_labels)
+    :return: dataframe of the IC, one row per factor and one column per horizon
+    """
+    factor_columns = factor_values.columns.difference(['y'])
+    x = factor_values[factor_columns].to_numpy(dtype=np.float64)
+    y = labels.to_numpy(dtype=np.float64)
+    valid = ~np.isnan(y)
+    weights = valid.astype(np.float64)
+    y = np.where(valid, y, 0)
+
+    # Sums over the valid ticks of each label, shape (factors, horizons)
+    n = weights.sum(axis=0)
+    sum_x = x.T @ weights
+    sum_xx = (x * x).T @ weights
+    sum_xy = x.T @ y
+    sum_y = y.sum(axis=0)
+    sum_yy = (y * y).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = sum_xy - sum_x * sum_y / n
+        variance_x = sum_xx - sum_x ** 2 / n
+        variance_y = sum_yy - sum_y ** 2 / n
+        ic = covariance / np.sqrt(variance_x * variance_y)
+    ic_decay = pd.DataFrame(ic, index=factor_columns, columns=labels.columns)
+
+    ic_decay.to_csv(output_path('IC_decay.csv', len(factor_values)))
+    return ic_decay
+
+
+def write_correlation(factor_correlation_matrix):
+    """
+        Output the correlation matrix of the factors (txt) and the heat map of abs(corr) to result.
+        Also outputs the pairs of factors with abs(corr) >= config.corr_threshold (Correlation_pairs.csv) and the
+        clusters of correlated factors (Correlation_clusters.csv). With many factors, the heat map is ordered by
+        cluster and drawn without annotations so that it stays readable and fast to render.
+    :param factor_correlation_matrix:
+    :return:
+    """
     # output corr.txt
     corr_matrix_path = os.path.join('result', 'Correlation_matrix.txt')
     with open(corr_matrix_path, 'w') as file:
         factor_correlation_matrix.to_string(file)
+
+    abs_correlation = np.abs(factor_correlation_matrix)
+    clusters = correlation_clusters(abs_correlation, config.corr_threshold)
+    clusters.to_csv(os.path.join('result', 'Correlation_clusters.csv'))
+    correlation_pairs(factor_correlation_matrix, config.corr_threshold).to_csv(
+        os.path.join('result', 'Correlation_pairs.csv'), index=False)
+
     # Heat map of output abs(corr)
-    plt.figure(figsize=(10, 8))
-    factor_correlation_matrix = np.abs(factor_correlation_matrix)
-    # Heatmap using seaborn's heatmap function
-    sns.heatmap(factor_correlation_matrix, annot=True, fmt=".2f", cmap='coolwarm', cbar=True, center=0)
-    plt.title('Correlation Matrix')
     heatmap_path = os.path.join('result', 'Correlation_matrix(abs).png')
+    if len(abs_correlation) <= 30:
+        plt.figure(figsize=(10, 8))
+        # Heatmap using seaborn's heatmap function
+        sns.heatmap(abs_correlation, annot=True, fmt=".2f", cmap='coolwarm', cbar=True, center=0)
+        plt.title('Correlation Matrix')
+    else:
+        # Factors of the same cluster next to each other, no annotations
+        order = clusters.sort_values(['cluster', 'order']).index
+        abs_correlation = abs_correlation.loc[order, order]
+        fig, ax = plt.subplots(figsize=(12, 10))
+        image = ax.imshow(abs_correlation.to_numpy(), cmap='coolwarm', vmin=0, vmax=1, interpolation='nearest')
+        fig.colorbar(image, ax=ax)
+        if len(order) <= 100:
+            ax.set_xticks(range(len(order)))
+            ax.set_xticklabels(order, rotation=90, fontsize=6)
+            ax.set_yticks(range(len(order)))
+            ax.set_yticklabels(order, fontsize=6)
+        ax.set_title('Correlation Matrix (clustered)')
     plt.savefig(heatmap_path)
+    plt.close()
 
-    # Calculate the head and tail 1% quantile for each factor
-    # Get the values of the factors except y
-    factor_columns = factor_values.columns.difference(['y'])
-    for factor in factor_columns:
-        # Calculate the 1% and 99% quantiles
-        q_low = factor_values[factor].quantile(0.01)
-        q_high = factor_values[factor].quantile(0.99)
-        # Filter out the 'y' values that correspond to these two quantiles
-        top_1_percent_y = factor_values[factor_values[factor] >= q_high]['y']
-        bottom_1_percent_y = factor_values[factor_values[factor] <= q_low]['y']
-        # calculate quantile mean
-        top_mean = top_1_percent_y.mean()
-        bottom_mean = bottom_1_percent_y.mean()
-        # Calculate the percentage greater than zero (win rate)
-        # sign of if correlation(IC) is positive or negative
-        sign = 1 if ic_values[factor]>0 else -1
-        # top_win_rate = top_1_percent_y[sign * top_1_percent_y > 0].count() / len(top_1_percent_y)
-        # bottom_win_rate = bottom_1_percent_y[sign * bottom_1_percent_y < 0].count() / len(bottom_1_percent_y)
-        top_win_rate = top_1_percent_y[sign * top_1_percent_y > 0].count() / top_1_percent_y[sign * top_1_percent_y != 0].count()
-        bottom_win_rate = bottom_1_percent_y[sign * bottom_1_percent_y < 0].count() / bottom_1_percent_y[sign * bottom_1_percent_y != 0].count()
-
-        results = results.append({'Factor': factor,
-                                  'IC':ic_values.loc[factor],
-                                  'Top 1% Mean y': top_mean,
-                                  'Bottom 1% Mean y': bottom_mean,
-                                  'top_win_rate': top_win_rate,
-                                  'bottom_win_rate': bottom_win_rate
-                                  }, ignore_index=True)
-    results = results.set_index('Factor')
-    results = results.reindex(results['IC'].abs().sort_values(ascending=False).index)
-    results.to_csv(factor_dir)
+
+def correlation_clusters(abs_correlation, threshold):
+    """
+        Hierarchical clustering (average linkage) of the factors on the distance 1 - abs(corr),
+        cut so that the factors of a cluster have an average abs(corr) >= threshold
+    :param abs_correlation: dataframe of abs(corr) of the factors
+    :param threshold:
+    :return: dataframe indexed by factor with the cluster id and the order of the factor in the dendrogram
+    """
+    if len(abs_correlation) < 2:
+        return pd.DataFrame({'cluster': 1, 'order': 0}, index=abs_correlation.index)
+    distance = 1 - np.nan_to_num(abs_correlation.to_numpy(), nan=0.0)
+    distance = np.clip((distance + distance.T) / 2, 0, 1)
+    np.fill_diagonal(distance, 0)
+    linkage = hierarchy.linkage(squareform(distance, checks=False), method='average')
+    clusters = hierarchy.fcluster(linkage, t=1 - threshold, criterion='distance')
+    order = np.empty(len(clusters), dtype=np.int64)
+    order[hierarchy.leaves_list(linkage)] = np.arange(len(clusters))
+    return pd.DataFrame({'cluster': clusters, 'order': order}, index=abs_correlation.index)
+
+
+def correlation_pairs(factor_correlation_matrix, threshold):
+    """
+        Pairs of factors with abs(corr) >= threshold, sorted by abs(corr)
+    :return: dataframe with columns factor1, factor2, corr
+    """
+    matrix = factor_correlation_matrix.to_numpy()
+    rows, cols = np.triu_indices(len(matrix), k=1)
+    keep = np.abs(matrix[rows, cols]) >= threshold
+    rows, cols = rows[keep], cols[keep]
+    names = factor_correlation_matrix.index
+    pairs = pd.DataFrame({'factor1': names[rows], 'factor2': names[cols], 'corr': matrix[rows, cols]})
+    return pairs.reindex(pairs['corr'].abs().sort_values(ascending=False).index)
+
+
+def write_daily_ic(daily_ic, n):
+    """
+        Output the IC of every factor on every day (daily_IC.csv)
+    :param daily_ic: dataframe indexed by day, one column per factor
+    :param n: number of ticks, to tell the test data from the total data
+    """
+    daily_ic.to_csv(output_path('daily_IC.csv', n))
+
+
+class CovarianceAccumulator:
+    """
+        Count, means and co-moments (centered sums of cross-products) of the factors and y, in float64.
+        update() adds one partition (e.g. one day), converting block_size factor columns at a time, and merge()
+        combines accumulators built by different workers (pairwise update of Chan et al.), so the factor values of the
+        whole history never need to be materialized at once. The IC of every partition is kept (daily IC).
+    """
+
+    def __init__(self, block_size=64):
+        self.block_size = block_size
+        self.columns = None
+        self.n = 0
+        self.mean = None
+        self.comoment = None
+        self.daily_ic = {}
+
+    def update(self, factor_values, label=None):
+        """
+            Add one partition
+        :param factor_values: dataframe of the factor values along with the y-values
+        :param label: name of the partition (e.g. the trading day) for the daily IC, None to not keep its IC
+        :return:
+        """
+        factor_values = factor_values[factor_values['y'].notna()]
+        if len(factor_values) == 0:
+            return self
+        if self.columns is None:
+            # y is kept as the last column
+            self.columns = list(factor_values.columns.difference(['y'])) + ['y']
+        blocks = [self.columns[i:i + self.block_size] for i in range(0, len(self.columns), self.block_size)]
+
+        # Means of the partition, then co-moments block by block: only two blocks of columns are converted at a time
+        mean = np.concatenate([factor_values[block].to_numpy(dtype=np.float64).mean(axis=0) for block in blocks])
+        comoment = np.empty((len(self.columns), len(self.columns)))
+        offsets = np.cumsum([0] + [len(block) for block in blocks])
+        for i, block_i in enumerate(blocks):
+            rows = slice(offsets[i], offsets[i + 1])
+            centered_i = factor_values[block_i].to_numpy(dtype=np.float64) - mean[rows]
+            for j in range(i, len(blocks)):
+                cols = slice(offsets[j], offsets[j + 1])
+                if j == i:
+                    centered_j = centered_i
+                else:
+                    centered_j = factor_values[blocks[j]].to_numpy(dtype=np.float64) - mean[cols]
+                comoment[rows, cols] = centered_i.T @ centered_j
+                comoment[cols, rows] = comoment[rows, cols].T
+
+        if label is not None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = np.diag(comoment)
+                ic = comoment[:-1, -1] / np.sqrt(variance[:-1] * variance[-1])
+            self.daily_ic[label] = pd.Series(ic, index=self.columns[:-1])
+        self._merge_moments(len(factor_values), mean, comoment)
+        return self
+
+    def merge(self, other):
+        """
+            Merge the accumulator of another partition (or worker) into this one
+        """
+        if other.columns is None:
+            return self
+        if self.columns is None:
+            self.columns = list(other.columns)
+        self._merge_moments(other.n, other.mean, other.comoment)
+        self.daily_ic.update(other.daily_ic)
+        return self
+
+    def _merge_moments(self, n, mean, comoment):
+        if self.n == 0:
+            self.n, self.mean, self.comoment = n, mean.copy(), comoment.copy()
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.comoment += comoment + np.outer(delta, delta) * (self.n * n / total)
+        self.mean += delta * (n / total)
+        self.n = total
+
+    def correlation(self):
+        """
+            Correlation matrix of the factors and y (y included), same as factor_values.corr()
+        """
+        std = np.sqrt(np.diag(self.comoment))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            correlation = self.comoment / np.outer(std, std)
+        return pd.DataFrame(correlation, index=self.columns, columns=self.columns)
+
+    def covariance(self):
+        """
+            Covariance matrix of the factors and y (y included), same as factor_values.cov()
+        """
+        return pd.DataFrame(self.comoment / (self.n - 1), index=self.columns, columns=self.columns)
+
+    def daily_ic_frame(self):
+        """
+            IC of every factor on every partition that had a label, one row per partition
+        """
+        return pd.DataFrame(self.daily_ic).T
+
+
+class QuantileEngine(abc.ABC):
+    """
+        Quantile statistics of one factor: y statistics of the ticks whose factor value lies in a range.
+        Subclasses implement quantile and range_stats, exactly (SortedFactor) or approximately (QuantileSketch).
+    """
+
+    @abc.abstractmethod
+    def quantile(self, q):
+        pass
+
+    @abc.abstractmethod
+    def range_stats(self, low, high):
+        """
+            y statistics of the ticks with low <= factor <= high
+        :param low: array of lower bounds
+        :param high: array of upper bounds
+        :return: (mean y, number of positive y, number of negative y), arrays
+        """
+
+    def tail_stats(self, q=0.01):
+        """
+            y statistics of the bottom q (factor <= q quantile) and of the top q (factor >= 1-q quantile)
+        :return: (bottom_mean, bottom_pos, bottom_neg), (top_mean, top_pos, top_neg)
+        """
+        q_low, q_high = self.quantile(np.array([q, 1 - q]))
+        mean, pos, neg = self.range_stats(np.array([-np.inf, q_high]), np.array([q_low, np.inf]))
+        return (mean[0], pos[0], neg[0]), (mean[1], pos[1], neg[1])
+
+    def buckets(self, levels):
+        """
+            Mean y of each quantile bucket, bucket i being quantile(levels[i]) <= factor <= quantile(levels[i + 1])
+        :param levels: quantile levels of the bucket edges, e.g. np.arange(0, 1.01, 0.01)
+        :return: array of len(levels) - 1 mean y
+        """
+        edges = self.quantile(np.asarray(levels))
+        mean, _, _ = self.range_stats(edges[:-1], edges[1:])
+        return mean
+
+
+class SortedFactor(QuantileEngine):
+    """
+        Exact quantile statistics from a single sort of the factor:
+        the cumulative count / sum / wins of y in the sort order give the statistics of any value range with two
+        searchsorted, instead of one boolean mask over the whole series per range.
+    """
+
+    def __init__(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        # nan factor values are ignored, as in Series.quantile
+        keep = ~np.isnan(x)
+        x, y = x[keep], y[keep]
+        order = np.argsort(x, kind='stable')
+        self.values = x[order]
+        y = y[order]
+        y_valid = ~np.isnan(y)
+        # count of non-nan y, sum of y, number of positive y, number of negative y, cumulated in the sort order
+        self.cumulative = np.zeros((4, len(y) + 1))
+        np.cumsum(y_valid, out=self.cumulative[0, 1:])
+        np.cumsum(np.where(y_valid, y, 0), out=self.cumulative[1, 1:])
+        np.cumsum(y > 0, out=self.cumulative[2, 1:])
+        np.cumsum(y < 0, out=self.cumulative[3, 1:])
+
+    def quantile(self, q):
+        # Linear interpolation between the closest ranks, as Series.quantile / np.quantile
+        position = np.asarray(q, dtype=np.float64) * (len(self.values) - 1)
+        low = np.floor(position).astype(np.intp)
+        high = np.minimum(low + 1, len(self.values) - 1)
+        fraction = position - low
+        a, b = self.values[low], self.values[high]
+        return np.where(fraction >= 0.5, b - (b - a) * (1 - fraction), a + (b - a) * fraction)
+
+    def range_stats(self, low, high):
+        start = np.searchsorted(self.values, low, side='left')
+        end = np.searchsorted(self.values, high, side='right')
+        count, y_sum, pos, neg = self.cumulative[:, end] - self.cumulative[:, start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return y_sum / count, pos, neg
+
+    def distribution(self, bins=30):
+        """
+            Same as np.histogram(x, bins, density=True)
+        """
+        return np.histogram(self.values, bins=bins, density=True)
+
+
+class QuantileSketch(QuantileEngine):
+    """
+        Mergeable approximation of SortedFactor for streaming / partitioned runs:
+        a fixed-bin histogram of the (standardized) factor values with, in every bin, the count, the count and sum of y
+        and the number of positive / negative y, plus the min and max. Results are exact up to the bin width
+        (2 * hist_range / n_bins); values outside of [-hist_range, hist_range] fall into the two outer bins.
+    """
+
+    def __init__(self, hist_range=10.0, n_bins=20000):
+        self.edges = np.linspace(-hist_range, hist_range, n_bins + 1)
+        # count, count of non-nan y, sum of y, number of positive y, number of negative y
+        self.bins = np.zeros((5, n_bins + 2))
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, x, y):
+        """
+            Add the factor values x and the corresponding y of one partition
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        keep = ~np.isnan(x)
+        x, y = x[keep], y[keep]
+        if len(x) == 0:
+            return self
+        bins = np.searchsorted(self.edges, x, side='right')
+        size = self.bins.shape[1]
+        y_valid = ~np.isnan(y)
+        self.bins[0] += np.bincount(bins, minlength=size)
+        self.bins[1] += np.bincount(bins, weights=y_valid, minlength=size)
+        self.bins[2] += np.bincount(bins, weights=np.where(y_valid, y, 0), minlength=size)
+        self.bins[3] += np.bincount(bins, weights=y > 0, minlength=size)
+        self.bins[4] += np.bincount(bins, weights=y < 0, minlength=size)
+        self.min = min(self.min, x.min())
+        self.max = max(self.max, x.max())
+        return self
+
+    def merge(self, other):
+        """
+            Merge the sketch of another partition into this one
+        """
+        self.bins += other.bins
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    def _bin_bounds(self):
+        # Lower and upper bound of every bin, the outer bins are bounded by the min and max
+        lower = np.concatenate([[self.min], self.edges])
+        upper = np.concatenate([self.edges, [self.max]])
+        return np.clip(lower, self.min, self.max), np.clip(upper, self.min, self.max)
+
+    def quantile(self, q):
+        # Rank q * (n - 1) as in SortedFactor, interpolated linearly inside the bin holding it
+        counts = self.bins[0]
+        cumulative = np.cumsum(counts)
+        rank = np.asarray(q, dtype=np.float64) * (cumulative[-1] - 1)
+        k = np.minimum(np.searchsorted(cumulative, rank, side='right'), len(counts) - 1)
+        lower, upper = self._bin_bounds()
+        fraction = (rank - (cumulative[k] - counts[k])) / np.maximum(counts[k], 1)
+        return lower[k] + (upper[k] - lower[k]) * np.clip(fraction, 0, 1)
+
+    def range_stats(self, low, high):
+        # Whole bins overlapping [low, high]
+        start = np.searchsorted(self.edges, low, side='right')
+        end = np.searchsorted(self.edges, high, side='right') + 1
+        cumulative = np.zeros((5, self.bins.shape[1] + 1))
+        np.cumsum(self.bins, axis=1, out=cumulative[:, 1:])
+        _, count, y_sum, pos, neg = cumulative[:, end] - cumulative[:, start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return y_sum / count, pos, neg
+
+    def distribution(self, bins=30):
+        """
+            Approximation of np.histogram(x, bins, density=True), the counts of each sketch bin are put at its center
+        """
+        lower, upper = self._bin_bounds()
+        return np.histogram(0.5 * (lower + upper), bins=bins, range=(self.min, self.max),
+                            weights=self.bins[0], density=True)
+
+
+class ICAccumulator:
+    """
+        The statistics needed by IC_quantile, accumulated one partition (e.g. one trading day) at a time,
+        so that the factor values of the whole history never need to be held in memory.
+        Accumulators of different partitions (e.g. built in different processes) can be merged.
+
+        Keeps:
+        1. a CovarianceAccumulator of the factors and y -> IC, corr matrix and daily IC
+        2. a QuantileSketch of each factor -> head and tail 1% mean y, win rates, quantile buckets and distribution
+    """
+
+    def __init__(self):
+        self.covariance = CovarianceAccumulator()
+        self.sketches = {}
+
+    @property
+    def n(self):
+        return self.covariance.n
+
+    def update(self, factor_values, label=None):
+        """
+            Add one partition
+        :param factor_values: dataframe of the factor values along with the y-values, as returned by pretreat_factor
+        :param label: name of the partition (e.g. the trading day) for the daily IC
+        :return:
+        """
+        factor_values = factor_values[factor_values['y'].notna()]
+        self.covariance.update(factor_values, label=label)
+        y = factor_values['y'].to_numpy(dtype=np.float64)
+        for factor in factor_values.columns.difference(['y']):
+            if factor not in self.sketches:
+                self.sketches[factor] = QuantileSketch()
+            self.sketches[factor].update(factor_values[factor].to_numpy(dtype=np.float64), y)
+
+    def merge(self, other):
+        """
+            Merge the accumulator of another partition into this one
+        """
+        self.covariance.merge(other.covariance)
+        for factor, sketch in other.sketches.items():
+            if factor not in self.sketches:
+                self.sketches[factor] = QuantileSketch()
+            self.sketches[factor].merge(sketch)
+        return self
+
+    def correlation(self):
+        """
+            Correlation matrix of the factors and y (y included), same as factor_values.corr()
+        """
+        return self.covariance.correlation()
+
+
+def IC_quantile_streaming(accumulator):
+    """
+        Same outputs as IC_quantile, computed from an ICAccumulator instead of the full factor dataframe
+    :param accumulator: ICAccumulator updated with all partitions
+    :return: outputs the IC for each factor and the corr of the factors to result
+    """
+    correlation_matrix = accumulator.correlation()
+    ic_values = correlation_matrix['y'].drop('y')
+    factor_correlation_matrix = correlation_matrix.drop('y', axis=0).drop('y', axis=1)
+    write_correlation(factor_correlation_matrix)
+    if accumulator.covariance.daily_ic:
+        write_daily_ic(accumulator.covariance.daily_ic_frame(), accumulator.n)
+
+    rows = [tail_row(factor, ic_values.loc[factor], accumulator.sketches[factor]) for factor in ic_values.index]
+    write_results(rows, accumulator.n)
     return
 
 
-def output(data):
+def output(data, ic_values=None):
     """
-        quantile histogram and statistical distribution analysis, graphical output in results folder
+        Head and tail 1% means of each factor (performance table), quantile histogram and statistical distribution
+        analysis, graphical output in results folder. Each factor is sorted once for both.
     :param data: also known as factor_values, same function as above.
-    :return: output the charts to result.
+    :param ic_values: IC of each factor (e.g. the 'y' column of the correlation of IC_quantile), None to compute it
+    :return: output the performance table and the charts to result.
+    """
+    if len(data) < 200000:   # plot iff it's total data
+        rows = factor_metrics(data, ic_values)
+    else:
+        rows = render_factors(data, ic_values)
+    write_results(rows, len(data))
+    return
+
+
+def render_factors(data, ic_values=None):
+    """
+        The charts of output, whatever the size of the data
+    :param data: factor_values
+    :param ic_values: see output
+    :return: list of tail_row
     """
     # Get all columns except 'y'
     factor_columns = data.columns.difference(['y'])
+    if ic_values is None:
+        ic_values = data[factor_columns].corrwith(data['y'])
+    y_hash = pd.util.hash_pandas_object(data['y'], index=False).to_numpy()
+    # Factors whose values did not change since their last rendering are not even sorted, the others are sorted in
+    # the workers
+    return render_report(((factor, ic_values[factor],
+                    input_fingerprint(SortedFactor, y_hash,
+                                      pd.util.hash_pandas_object(data[factor], index=False).to_numpy()), None)
+                   for factor in factor_columns), data=data)
 
-    for factor in factor_columns:
-        # Create a separate folder for each factor to hold plots
-        if len(data) < 200000:   # plot iff it's total data
-            continue
-        else:
-            factor_dir = os.path.join('result', factor)
-
-        if not os.path.exists(factor_dir):
-            os.makedirs(factor_dir)
-
-        # # 1.ACF
-        # fig, ax = plt.subplots(figsize=(10, 4))
-        # plot_acf(data[factor].iloc[:150000], ax=ax, lags=20, title=f'Autocorrelation for {factor}')
-        # acf_path = os.path.join(factor_dir, f'{factor}-ACF.png')
-        # plt.savefig(acf_path)
-        # plt.close(fig)
-
-        # Calculate bins and counts for histograms
-        counts, bin_edges = np.histogram(data[factor], bins=30, density=True)
-        bin_centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
-
-        # 2. Plotting line graphs for histograms
-        plt.figure(figsize=(10, 6))
-        plt.plot(bin_centers, counts, linestyle='-', marker='o', color='b')
-        plt.title(f'Probability Density Function - {factor}')
-        plt.xlabel('Factor Value')
-        plt.ylabel('Density')
-        plt.grid(True)
-        distribution_path = os.path.join(factor_dir, f'{factor}-distribution.png')
-        plt.savefig(distribution_path)
-        plt.close()
-
-        # 3. Generate y-means for each quantile
-        fig, ax = plt.subplots(figsize=(10, 6))
-        bins = np.arange(0, 1.01, 0.01)  # Sub-boxes for generating histograms
-        bin_means = []
-        # Get the y-mean for each quartile
-        for i in range(len(bins) - 1):
-            left = bins[i]
-            right = bins[i + 1]
-            # todo: is it really better to set it to null, or is it better to juxtapose the values?
-            y_values = data[(data[factor] >= data[factor].quantile(left)) & (data[factor] <= data[factor].quantile(right))]['y']
-            mean_y = y_values.mean()
-            bin_means.append(mean_y)
-        ax.bar(bins[:-1], bin_means, width=0.01)
-        ax.set_xticks(np.arange(0, 1.01, 0.1))
-        ax.set_xlabel('Quantile Range')
-        ax.set_ylabel('Mean y')
-        ax.set_title(f'Mean y by {factor} Quantile Ranges')
-        hist_path = os.path.join(factor_dir, f'{factor}_quantile_histogram.png')
-        fig.savefig(hist_path, dpi=300, bbox_inches='tight')
-        plt.close(fig)
 
+def output_streaming(accumulator):
+    """
+        Same as output, approximated from the quantile sketches of an ICAccumulator
+    :param accumulator: ICAccumulator updated with all partitions
+    :return: output the charts to result.
+    """
+    if accumulator.n < 200000:   # plot iff it's total data
+        return
+    ic_values = accumulator.correlation()['y']
+    render_report((factor, ic_values[factor],
+                   input_fingerprint(QuantileSketch, sketch.edges, sketch.bins, [sketch.min, sketch.max]), sketch)
+                  for factor, sketch in accumulator.sketches.items())
     return
 
 
+def render_report(factors, data=None, n_jobs=None):
+    """
+        Render the figures of the factors in a process pool, and the html report (config.html_report).
+        Each worker computes the statistics and the figure data of its factor and draws them. A factor whose inputs
+        have the same fingerprint as at its last rendering (result/<factor>/.rendered.json) is skipped altogether:
+        its performance row is read back from there and its engine is never built.
+    :param factors: iterable of (factor name, IC, input_fingerprint of the factor, QuantileSketch of the factor or
+                    None to sort data[factor] into a SortedFactor)
+    :param data: factor values along with y, for the factors without an engine
+    :param n_jobs: number of worker processes, defaults to config.n_jobs (None means all cores, 1 means serial)
+    :return: list of tail_row of the factors
+    """
+    n_jobs = config.n_jobs if n_jobs is None else n_jobs
+    rows = []
+    tasks = []
+    for factor, ic, fingerprint, engine in factors:
+        rendered = read_rendered(factor)
+        if rendered is not None and rendered['fingerprint'] == fingerprint:
+            rows.append(rendered['row'])
+        else:
+            tasks.append((factor, ic, fingerprint, engine))
+    skipped = len(rows)
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        for factor, ic, fingerprint, engine in tasks:
+            if engine is None:
+                engine = SortedFactor(data[factor], data['y'])
+            rows.append(render_factor(factor, ic, fingerprint, engine))
+    else:
+        # The factors to sort are published in shared memory a batch at a time (a copy of a few columns only)
+        batch_size = 2 * (n_jobs or os.cpu_count())
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            for i in range(0, len(tasks), batch_size):
+                batch = tasks[i:i + batch_size]
+                columns = [factor for factor, _, _, engine in batch if engine is None]
+                book = shared_book.publish_book(data, columns + ['y']) if columns else None
+                try:
+                    futures = [executor.submit(render_factor, factor, ic, fingerprint,
+                                               book.descriptor if engine is None else engine)
+                               for factor, ic, fingerprint, engine in batch]
+                    rows += [future.result() for future in futures]
+                finally:
+                    if book is not None:
+                        book.close()
+    print(f"rendered {len(rows) - skipped} of {len(rows)} factors (unchanged factors are skipped)")
+
+    if config.html_report:
+        write_html_report(rows)
+    return rows
+
+
+def render_factor(factor, ic, fingerprint, engine):
+    """
+        Performance row, figure data and figures of one factor, run in the worker processes
+    :param factor: factor name
+    :param ic: IC of the factor
+    :param fingerprint: input_fingerprint of the factor
+    :param engine: SortedFactor or QuantileSketch of the factor, or the descriptor of a shared_book.publish_book
+                   with the factor and y, sorted here into a SortedFactor
+    :return: tail_row of the factor
+    """
+    if isinstance(engine, shared_book.Descriptor):
+        descriptor = engine
+        views = shared_book.attach(descriptor)
+        engine = SortedFactor(views[factor], views['y'])
+        # The sorted values are copies, the block of the batch is released
+        del views
+        shared_book.detach(descriptor)
+    row = tail_row(factor, ic, engine)
+    figure = figure_data(factor, engine)
+    figure['fingerprint'] = fingerprint
+    figure['row'] = row
+    plot_factor(figure)
+    return row
+
+
+def figure_data(factor, engine):
+    """
+        Everything plot_factor draws for one factor
+    :param factor: factor name
+    :param engine: SortedFactor or QuantileSketch of the factor
+    :return: dict
+    """
+    # Calculate bins and counts for histograms
+    counts, bin_edges = engine.distribution(bins=30)
+    # Get the y-mean for each quartile, the ticks on an edge are in both buckets
+    # todo: is it really better to set it to null, or is it better to juxtapose the values?
+    bins = np.arange(0, 1.01, 0.01)  # Sub-boxes for generating histograms
+    bin_means = engine.buckets(bins)
+    return {'factor': factor, 'counts': counts, 'bin_edges': bin_edges, 'bins': bins, 'bin_means': bin_means}
+
+
+def input_fingerprint(engine_class, *arrays):
+    """
+        Fingerprint of everything the figures and the performance row of a factor depend on: the code computing and
+        drawing them and the arrays the engine is built from (e.g. hashes of the factor values and y, which also
+        determine the IC)
+    :param engine_class: SortedFactor or QuantileSketch
+    :param arrays:
+    :return: hex digest
+    """
+    md5 = hashlib.md5()
+    for function in (engine_class, tail_row, figure_data, plot_factor):
+        md5.update(inspect.getsource(function).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        md5.update(array.dtype.str.encode())
+        md5.update(array.tobytes())
+    return md5.hexdigest()
+
+
+def read_rendered(factor):
+    """
+        Fingerprint and performance row of the last rendering of the factor, None if its figures are missing
+    :return: dict with fingerprint and row
+    """
+    factor_dir = os.path.join('result', factor)
+    paths = [os.path.join(factor_dir, name) for name in (f'{factor}-distribution.png', f'{factor}_quantile_histogram.png')]
+    rendered_path = os.path.join(factor_dir, '.rendered.json')
+    if not all(os.path.exists(path) for path in paths + [rendered_path]):
+        return None
+    with open(rendered_path) as file:
+        return json.load(file)
+
+
+def plot_factor(figure):
+    """
+        Distribution and quantile y-mean histogram of one factor, run in the worker processes
+    :param figure: figure_data of the factor
+    :return:
+    """
+    factor = figure['factor']
+    # Create a separate folder for each factor to hold plots
+    factor_dir = os.path.join('result', factor)
+    if not os.path.exists(factor_dir):
+        os.makedirs(factor_dir)
+
+    # # 1.ACF
+    # fig, ax = plt.subplots(figsize=(10, 4))
+    # plot_acf(data[factor].iloc[:150000], ax=ax, lags=20, title=f'Autocorrelation for {factor}')
+    # acf_path = os.path.join(factor_dir, f'{factor}-ACF.png')
+    # plt.savefig(acf_path)
+    # plt.close(fig)
+
+    bin_edges = figure['bin_edges']
+    bin_centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+
+    # 2. Plotting line graphs for histograms
+    plt.figure(figsize=(10, 6))
+    plt.plot(bin_centers, figure['counts'], linestyle='-', marker='o', color='b')
+    plt.title(f'Probability Density Function - {factor}')
+    plt.xlabel('Factor Value')
+    plt.ylabel('Density')
+    plt.grid(True)
+    distribution_path = os.path.join(factor_dir, f'{factor}-distribution.png')
+    plt.savefig(distribution_path)
+    plt.close()
+
+    # 3. Generate y-means for each quantile
+    fig, ax = plt.subplots(figsize=(10, 6))
+    bins = figure['bins']
+    ax.bar(bins[:-1], figure['bin_means'], width=0.01)
+    ax.set_xticks(np.arange(0, 1.01, 0.1))
+    ax.set_xlabel('Quantile Range')
+    ax.set_ylabel('Mean y')
+    ax.set_title(f'Mean y by {factor} Quantile Ranges')
+    hist_path = os.path.join(factor_dir, f'{factor}_quantile_histogram.png')
+    fig.savefig(hist_path, dpi=300, bbox_inches='tight')
+    plt.close(fig)
+
+    # Written last, so that an interrupted rendering is redone
+    with open(os.path.join(factor_dir, '.rendered.json'), 'w') as file:
+        json.dump({'fingerprint': figure['fingerprint'], 'row': figure['row']}, file, default=float)
+
+
+def write_html_report(rows, path='result/report.html'):
+    """
+        Single self-contained html file (images embedded in base64) with the performance table and the figures
+        of every factor, sorted by abs(IC)
+    :param rows: list of tail_row
+    :param path:
+    :return:
+    """
+    results = results_table(rows)
+    sections = []
+    for factor in results.index:
+        images = []
+        for name in (f'{factor}-distribution.png', f'{factor}_quantile_histogram.png'):
+            with open(os.path.join('result', factor, name), 'rb') as file:
+                encoded = base64.b64encode(file.read()).decode()
+            images.append(f'<img src="data:image/png;base64,{encoded}" width="600">')
+        sections.append(f'<h2 id="{html.escape(factor)}">{html.escape(factor)}</h2>\n'
+                        + results.loc[[factor]].to_html(float_format='{:.4f}'.format) + '\n' + '\n'.join(images))
+    with open(path, 'w') as file:
+        file.write('<html><head><meta charset="utf-8"><title>Factor report</title></head><body>\n'
+                   '<h1>Factor performance</h1>\n'
+                   + results.to_html(float_format='{:.4f}'.format) + '\n'
+                   + '\n'.join(sections) + '\n</body></html>\n')
+
+
 def orthogonal(factor1, factor2):    # didn't used here
     """
         Orthogonalizes factor1 using factor2 as a reference. Returns orthogonalized factor1
@@ -158,3 +856,141 @@ def orthogonal(factor1, factor2):    # didn't used here
 
 
 
+
+
+class Residualization:
+    """
+        Least-squares residualization of many factors against a base set of factors (e.g. the existing library),
+        fitted on the covariance matrix of a CovarianceAccumulator instead of the tick data:
+        factor = intercept + base @ betas + residual, with the residuals uncorrelated with the base factors.
+        The residual covariance and IC come from the covariance matrix as well; apply() computes the residual
+        factor values on tick data block_size columns at a time.
+    """
+
+    def __init__(self, accumulator, factors, base, block_size=64):
+        """
+        :param accumulator: CovarianceAccumulator of (at least) the factors, the base factors and y
+        :param factors: factors to residualize
+        :param base: factors to residualize against
+        :param block_size: number of factor columns solved / converted at a time
+        """
+        self.factors = list(factors)
+        self.base = list(base)
+        self.block_size = block_size
+        position = {column: i for i, column in enumerate(accumulator.columns)}
+        f = [position[column] for column in self.factors]
+        b = [position[column] for column in self.base]
+        y = position['y']
+        covariance = accumulator.comoment / (accumulator.n - 1)
+
+        # Normal equations cov_bb @ betas = cov_bf, solved by least squares (also for collinear base factors)
+        cov_bb = covariance[np.ix_(b, b)]
+        self.betas = np.empty((len(b), len(f)))
+        for start in range(0, len(f), block_size):
+            block = f[start:start + block_size]
+            self.betas[:, start:start + block_size] = np.linalg.lstsq(cov_bb, covariance[np.ix_(b, block)], rcond=None)[0]
+        self.intercept = accumulator.mean[f] - self.betas.T @ accumulator.mean[b]
+
+        # Covariance of the residuals and y: cov(f - B'b, f - B'b) and cov(f - B'b, y)
+        cov_fb_betas = covariance[np.ix_(f, b)] @ self.betas
+        residual = np.empty((len(f) + 1, len(f) + 1))
+        residual[:-1, :-1] = covariance[np.ix_(f, f)] - cov_fb_betas - cov_fb_betas.T + self.betas.T @ cov_bb @ self.betas
+        residual[:-1, -1] = residual[-1, :-1] = covariance[f, y] - self.betas.T @ covariance[b, y]
+        residual[-1, -1] = covariance[y, y]
+        self.covariance = pd.DataFrame(residual, index=self.factors + ['y'], columns=self.factors + ['y'])
+
+    def ic(self):
+        """
+            IC of the residual of each factor
+        """
+        residual = self.covariance.to_numpy()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ic = residual[:-1, -1] / np.sqrt(np.diag(residual)[:-1] * residual[-1, -1])
+        return pd.Series(ic, index=self.factors)
+
+    def apply(self, factor_values):
+        """
+            Residual factor values on tick data
+        :param factor_values: dataframe with the factors and the base factors (and optionally y)
+        :return: dataframe of the residuals (and y)
+        """
+        base_values = factor_values[self.base].to_numpy(dtype=np.float64)
+        residuals = np.empty((len(factor_values), len(self.factors)))
+        for start in range(0, len(self.factors), self.block_size):
+            block = slice(start, start + self.block_size)
+            residuals[:, block] = factor_values[self.factors[block]].to_numpy(dtype=np.float64)
+            residuals[:, block] -= base_values @ self.betas[:, block]
+            residuals[:, block] -= self.intercept[block]
+        result = pd.DataFrame(residuals, index=factor_values.index, columns=self.factors)
+        if 'y' in factor_values.columns:
+            result['y'] = factor_values['y']
+        return result
+
+
+def residualize(accumulator, factors, base, block_size=64):
+    """
+        Batched version of orthogonal: residualize every factor in factors against all the factors in base at once
+    :return: Residualization
+    """
+    return Residualization(accumulator, factors, base, block_size=block_size)
+
+
+def select_factors(accumulator, max_factors=None, min_ic=0.0, max_corr=None):
+    """
+        Greedy forward selection by incremental IC. At each step the factor whose part orthogonal to the factors
+        already selected has the largest abs(corr) with y (semi-partial correlation) is added.
+        After each pick the residual covariance of all the candidates is updated with one rank-1 step
+        (Gram-Schmidt on the correlation matrix), so no regression is refitted per candidate.
+    :param accumulator: CovarianceAccumulator of the factors and y
+    :param max_factors: stop after this many factors, None for no limit
+    :param min_ic: stop when the best incremental abs(IC) is below this
+    :param max_corr: drop the candidates with abs(corr) above this with a selected factor, None for no cap
+    :return: dataframe, one row per selected factor in the order of selection: IC, incremental IC, R2 of the selected
+             set (share of the variance of y explained), max abs(corr) with the factors selected before
+    """
+    correlation = accumulator.correlation()
+    factor_names = correlation.columns[:-1]
+    raw = correlation.to_numpy()
+    n_factors = len(factor_names)
+    # Constant factors have nan correlations
+    eligible = np.isfinite(raw[:n_factors, -1])
+    residual = np.nan_to_num(raw)
+
+    rows = []
+    selected = []
+    r2 = 0.0
+    while eligible.any() and (max_factors is None or len(selected) < max_factors):
+        variance = np.diag(residual)[:n_factors]
+        # Candidates (almost) spanned by the selected factors have nothing left
+        candidates = eligible & (variance > 1e-10)
+        if not candidates.any():
+            break
+        with np.errstate(invalid='ignore', divide='ignore'):
+            incremental = residual[:n_factors, -1] / np.sqrt(variance)
+        k = np.flatnonzero(candidates)[np.argmax(np.abs(incremental[candidates]))]
+        if abs(incremental[k]) < min_ic:
+            break
+
+        r2 += incremental[k] ** 2
+        rows.append({'Factor': factor_names[k],
+                     'IC': raw[k, -1],
+                     'incremental_IC': incremental[k],
+                     'R2': r2,
+                     'max_corr': np.abs(raw[k, selected]).max() if selected else 0.0})
+        selected.append(k)
+        eligible[k] = False
+        if max_corr is not None:
+            eligible &= np.abs(raw[k, :n_factors]) <= max_corr
+        # Remove the new factor from every column (rank-1 update of the residual covariance)
+        residual -= np.outer(residual[:, k], residual[k, :]) / residual[k, k]
+
+    return pd.DataFrame(rows, columns=['Factor', 'IC', 'incremental_IC', 'R2', 'max_corr']).set_index('Factor')
+
+
+def write_selection(selection, n):
+    """
+        Output the result of select_factors to factor_selection.csv
+    :param selection: dataframe returned by select_factors
+    :param n: number of ticks, to tell the test data from the total data
+    """
+    selection.to_csv(output_path('factor_selection.csv', n))
@@ -0,0 +1,105 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import config
+import Data_Process
+import factors
+import factor_store
+import performance_analysis
+import streaming
+
+
+def day_tasks(product_list):
+    """
+        (product, folder, csv file name) of every trading day of every product, largest csv first:
+        the long days start first and the short ones fill the gaps at the end, which balances the workers
+    :param product_list:
+    :return: list of tasks
+    """
+    tasks = []
+    for product in product_list:
+        folder_path = config.product_settings(product)['data_path']
+        for file in os.listdir(folder_path):
+            if file.endswith('.csv'):
+                size = os.path.getsize(os.path.join(folder_path, file))
+                tasks.append((size, product, folder_path, file))
+    tasks.sort(key=lambda task: task[0], reverse=True)
+    return [task[1:] for task in tasks]
+
+
+def run_day(product, folder_path, file, factor_list, columns):
+    """
+        One trading day of one product, run in the worker processes: parse (or load from the cache), clean,
+        factors, pretreatment, and the covariance of the factors and y of the day
+    :return: product, CovarianceAccumulator of the day (with its daily IC)
+    """
+    cache_path = Data_Process.build_cache(folder_path, files=[file], n_jobs=1)[0]
+    l2 = pd.read_parquet(cache_path, columns=columns)
+    day = str(l2['TradingDay'].iloc[0])
+    # One store per product, the trading days of different products have the same names
+    store = None if config.factor_store is None else factor_store.FactorStore(os.path.join(config.factor_store, product))
+    factor = streaming.process_day(l2, factor_list, store=store, settings=config.product_settings(product))
+    covariance = performance_analysis.CovarianceAccumulator()
+    covariance.update(factor, label=day)
+    return product, covariance
+
+
+def _init_worker():
+    # The days are the unit of parallelism, no nested pools in the workers
+    config.n_jobs = 1
+
+
+def run(product_list, factor_list, n_jobs=None):
+    """
+        Evaluate the factors on all products x trading days in one shared process pool.
+        Days are scheduled largest first and the covariance accumulators of the days are merged per product, so only
+        one day per worker is in memory.
+    :param product_list: products, configured in config.products
+    :param factor_list:
+    :param n_jobs: number of worker processes, defaults to config.n_jobs (None means all cores, 1 means serial)
+    :return: dict product -> CovarianceAccumulator of all its days
+    """
+    n_jobs = config.n_jobs if n_jobs is None else n_jobs
+    columns = Data_Process.BASE_COLUMNS + [col for col in factors.required_columns(factor_list) if col not in Data_Process.BASE_COLUMNS]
+    tasks = day_tasks(product_list)
+    accumulators = {product: performance_analysis.CovarianceAccumulator() for product in product_list}
+    if n_jobs == 1:
+        for task in tasks:
+            product, covariance = run_day(*task, factor_list, columns)
+            accumulators[product].merge(covariance)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as executor:
+            futures = [executor.submit(run_day, *task, factor_list, columns) for task in tasks]
+            for future in as_completed(futures):
+                product, covariance = future.result()
+                accumulators[product].merge(covariance)
+    return accumulators
+
+
+def cross_product_ic(accumulators):
+    """
+        IC of every factor on every product, with the mean and the min / max over the products,
+        and the mean daily IC / its std (IC IR) pooled over all the days of all products
+    :param accumulators: dict product -> CovarianceAccumulator
+    :return: dataframe, one row per factor
+    """
+    table = pd.DataFrame({product: covariance.correlation()['y'].drop('y')
+                          for product, covariance in accumulators.items() if covariance.n > 0})
+    ic_values = table.to_numpy()
+    table['mean'] = ic_values.mean(axis=1)
+    table['min'] = ic_values.min(axis=1)
+    table['max'] = ic_values.max(axis=1)
+    daily_ic = pd.concat([covariance.daily_ic_frame() for covariance in accumulators.values() if covariance.daily_ic])
+    table['daily_IC_IR'] = daily_ic.mean() / daily_ic.std()
+    return table.reindex(table['mean'].abs().sort_values(ascending=False).index)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    accumulators = run(config.product_list, config.factor_list)
+    table = cross_product_ic(accumulators)
+    print(table)
+    n = sum(covariance.n for covariance in accumulators.values())
+    table.to_csv(performance_analysis.output_path('cross_product_IC.csv', n))
+    print(f"program runtime：{time.time() - start_time} seconds")
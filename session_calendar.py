@@ -0,0 +1,140 @@
+import numpy as np
+
+
+NS_PER_SECOND = 10 ** 9
+NS_PER_DAY = 86400 * NS_PER_SECOND
+
+# Day sessions are the same for all SHFE products: (start, end, is_opening)
+# is_opening: the session starts after a close (night -> morning, lunch -> afternoon), not after the 10:15 break.
+# Only openings are kept when config.divide_time_range is True.
+DAY_SESSIONS = [('09:00:00', '10:15:00', True),
+                ('10:30:00', '11:30:00', False),
+                ('13:30:00', '15:00:00', True)]
+
+# Close of the night session (which always opens at 21:00) of each SHFE product, None if there is no night session
+NIGHT_CLOSE = {
+    'cu': '01:00:00', 'al': '01:00:00', 'zn': '01:00:00', 'pb': '01:00:00', 'ni': '01:00:00', 'sn': '01:00:00',
+    'ss': '01:00:00', 'ao': '01:00:00',
+    'au': '02:30:00', 'ag': '02:30:00',
+    'rb': '23:00:00', 'hc': '23:00:00', 'bu': '23:00:00', 'ru': '23:00:00', 'fu': '23:00:00', 'sp': '23:00:00',
+    'br': '23:00:00',
+    'wr': None,
+}
+
+
+def sessions(product):
+    """
+        Trading sessions of a product, in the order of a trading day
+    :param product: SHFE product code, e.g. 'ss'
+    :return: list of (start, end, is_opening), times as 'HH:MM:SS' strings
+    """
+    night_close = NIGHT_CLOSE[product]
+    if night_close is None:
+        return list(DAY_SESSIONS)
+    return [('21:00:00', night_close, True)] + DAY_SESSIONS
+
+
+def to_ns(time_str):
+    """
+        'HH:MM:SS' -> nanoseconds since midnight
+    """
+    hours, minutes, seconds = (int(part) for part in time_str.split(':'))
+    return (hours * 3600 + minutes * 60 + seconds) * NS_PER_SECOND
+
+
+def time_of_day(index):
+    """
+        Nanoseconds since midnight of each timestamp, as int64
+    :param index: DatetimeIndex
+    """
+    return index.asi8 % NS_PER_DAY
+
+
+def compile_intervals(intervals):
+    """
+        Compile closed intervals [start, end] of nanoseconds since a session start (end may be past midnight)
+        into sorted boundaries, splitting the intervals that cross midnight and merging the pieces that overlap or
+        touch, so that the boundaries are strictly increasing.
+    :param intervals: list of (start, end) in ns, start in [0, NS_PER_DAY), end >= start
+    :return: sorted int64 array [start0, end0 + 1, start1, end1 + 1, ...]
+    """
+    pieces = []
+    for start, end in intervals:
+        if end < start:
+            continue
+        if start >= NS_PER_DAY:
+            start, end = start - NS_PER_DAY, end - NS_PER_DAY
+        if end >= NS_PER_DAY:
+            pieces.append((start, NS_PER_DAY - 1))
+            pieces.append((0, min(end - NS_PER_DAY, NS_PER_DAY - 1)))
+        else:
+            pieces.append((start, end))
+    merged = []
+    for start, end in sorted(pieces):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    boundaries = []
+    for start, end in merged:
+        boundaries += [start, end + 1]
+    return np.array(boundaries, dtype=np.int64)
+
+
+def in_intervals(tod, boundaries):
+    """
+        Whether each time of day falls in one of the compiled intervals.
+        A time is inside iff an odd number of boundaries are <= it.
+    :param tod: int64 array, nanoseconds since midnight
+    :param boundaries: output of compile_intervals
+    :return: boolean array
+    """
+    return (np.searchsorted(boundaries, tod, side='right') & 1).astype(bool)
+
+
+def trading_boundaries(product, n1=0, n2=0):
+    """
+        Boundaries of the trading sessions of a product, without the first n1 and the last n2 seconds of each session
+    """
+    intervals = []
+    for start, end, _ in sessions(product):
+        start_ns, end_ns = to_ns(start), to_ns(end)
+        if end_ns <= start_ns:     # the night session closes after midnight
+            end_ns += NS_PER_DAY
+        intervals.append((start_ns + n1 * NS_PER_SECOND, end_ns - n2 * NS_PER_SECOND))
+    return compile_intervals(intervals)
+
+
+def opening_boundaries(product, open_seconds):
+    """
+        Boundaries of the first open_seconds seconds after each opening of a product
+    """
+    intervals = []
+    for start, _, is_opening in sessions(product):
+        if is_opening:
+            start_ns = to_ns(start)
+            intervals.append((start_ns, start_ns + open_seconds * NS_PER_SECOND))
+    return compile_intervals(intervals)
+
+
+def session_ids(index, product):
+    """
+        Id of the trading session of each timestamp, different for every session of every day, -1 outside the sessions.
+        A night session that closes after midnight keeps one id on both sides of midnight.
+    :param index: DatetimeIndex
+    :param product: SHFE product code
+    :return: int64 array
+    """
+    product_sessions = sessions(product)
+    tod = time_of_day(index)
+    timestamps = index.asi8
+    ids = np.full(len(index), -1, dtype=np.int64)
+    for k, (start, end, _) in enumerate(product_sessions):
+        start_ns, end_ns = to_ns(start), to_ns(end)
+        if end_ns <= start_ns:
+            end_ns += NS_PER_DAY
+        inside = in_intervals(tod, compile_intervals([(start_ns, end_ns)]))
+        # Day on which the session started
+        start_day = (timestamps[inside] - start_ns) // NS_PER_DAY
+        ids[inside] = start_day * len(product_sessions) + k
+    return ids
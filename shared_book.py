@@ -0,0 +1,131 @@
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+
+# Name of the timestamp index (int64 nanoseconds) in a published book
+INDEX = '__index__'
+# Arrays start on cache line boundaries
+ALIGNMENT = 64
+
+# Shared memory blocks attached in this process, by name. They stay open for the life of the (worker) process,
+# so that the views handed out never outlive their buffer, unless they are detach()ed
+_attached = {}
+
+
+@dataclass(frozen=True)
+class Descriptor:
+    """
+        Picklable description of a SharedBlock, all that is sent to the worker processes
+    :param name: name of the shared memory block
+    :param layout: (array name, dtype, shape, offset in bytes, order) of every array of the block
+    """
+    name: str
+    layout: tuple
+
+
+class SharedBlock:
+    """
+        Named numpy arrays in one shared memory block. The process creating it owns it (arrays are writable views,
+        close() frees it); the other processes attach() to it with its descriptor and get views, without any copy.
+    """
+
+    def __init__(self, specs):
+        """
+        :param specs: dict array name -> (shape, dtype, order), order 'C' or 'F'
+        """
+        layout = []
+        offset = 0
+        for name, (shape, dtype, order) in specs.items():
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+            dtype = np.dtype(dtype)
+            layout.append((name, dtype.str, tuple(shape), offset, order))
+            offset += int(np.prod(shape)) * dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        self.descriptor = Descriptor(self.shm.name, tuple(layout))
+        self.arrays = _views(self.shm, self.descriptor.layout, writeable=True)
+
+    def close(self):
+        """
+            Free the block. Views of self.arrays must not be used afterwards
+        """
+        self.arrays = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _views(shm, layout, writeable):
+    views = {}
+    for name, dtype, shape, offset, order in layout:
+        view = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset, order=order)
+        view.flags.writeable = writeable
+        views[name] = view
+    return views
+
+
+def publish_book(data, columns):
+    """
+        Copy columns of the cleaned data (in their own dtype, e.g. the float32 columns of the compact cache) and the
+        timestamp index into shared memory, once for all the workers
+    :param data: cleaned data, as returned by Data_Process.clean_l2_data
+    :param columns: numeric columns to publish
+    :return: SharedBlock, to be closed by the caller when the workers are done
+    """
+    specs = {column: ((len(data),), data[column].dtype, 'C') for column in columns}
+    specs[INDEX] = ((len(data),), np.int64, 'C')
+    block = SharedBlock(specs)
+    for column in columns:
+        block.arrays[column][:] = data[column].to_numpy()
+    block.arrays[INDEX][:] = data.index.asi8
+    return block
+
+
+def create_matrix(shape, dtype=np.float64):
+    """
+        Shared result matrix, in column-major order so that the column of each factor is contiguous
+    :param shape: (number of ticks, number of factors)
+    :return: SharedBlock with the matrix as arrays['values']
+    """
+    return SharedBlock({'values': (shape, dtype, 'F')})
+
+
+def attach(descriptor, writeable=False):
+    """
+        Views of the arrays of a SharedBlock created by another process
+    :param descriptor: SharedBlock.descriptor
+    :param writeable: False for read-only views (the book), True for the result matrix
+    :return: dict array name -> view
+    """
+    shm = _attached.get(descriptor.name)
+    if shm is None:
+        shm = _attached[descriptor.name] = shared_memory.SharedMemory(name=descriptor.name)
+    return _views(shm, descriptor.layout, writeable)
+
+
+def detach(descriptor):
+    """
+        Close the block attached in this process, e.g. in a long-lived worker once it is done with a block that the
+        owner frees. All the views of the block must have been dropped
+    """
+    shm = _attached.pop(descriptor.name, None)
+    if shm is not None:
+        shm.close()
+
+
+def book_slice(views, start, end):
+    """
+        Rows start:end of an attached book
+    :param views: attach() of a publish_book descriptor
+    :return: dict column -> read-only view, DatetimeIndex of the rows
+    """
+    index = pd.DatetimeIndex(views[INDEX][start:end].view('M8[ns]'))
+    columns = {name: view[start:end] for name, view in views.items() if name != INDEX}
+    return columns, index
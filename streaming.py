@@ -0,0 +1,62 @@
+import os
+import pandas as pd
+import config
+import Data_Process
+import factors
+import performance_analysis
+import factor_store
+import instrumentation
+
+
+def iter_days(folder_path, columns=None, files=None):
+    """
+        Read the data one trading day (one csv) at a time, instead of concatting the whole history
+    :param folder_path:
+    :param columns: only load these columns, None for all columns
+    :param files: only load these csv file names, None for all csv's in the folder
+    :return: generator of the raw data of each day
+    """
+    for cache_path in Data_Process.build_cache(folder_path, files=files):
+        yield pd.read_parquet(cache_path, columns=columns)
+
+
+def process_day(l2, factor_list, store=None, settings=None):
+    """
+        Push the raw data of one day through the same stages as main_demo:
+        clean_l2_data -> factor_time_range -> get_alpha -> pretreat_factor
+        Note that the factors are standardized with the mean and std of this day, not of the whole history.
+    :param l2: raw data of one day
+    :param factor_list:
+    :param store: FactorStore, None to compute all the factors
+    :param settings: product_settings of the product of the data, None for the settings of config.product
+    :return: processed factor values along with y of this day
+    """
+    settings = config.product_settings(config.product) if settings is None else settings
+    data = Data_Process.clean_l2_data(l2)
+    factor_index = Data_Process.factor_time_range(data.index, n1=settings['n1'], n2=settings['n2'],
+                                                  product=settings['product'], open_minutes=settings['open_minutes'],
+                                                  divide_time_range=settings['divide_time_range'])
+    factor = factors.get_alpha(data, factor_index, factor_list, store=store)
+    factor = Data_Process.pretreat_factor(factor, data)
+    return factor
+
+
+def run(folder_path, factor_list, columns=None, files=None):
+    """
+        Streaming version of STEP1-STEP2 of main_demo: days are processed one by one and only the statistics
+        needed by IC_quantile are kept, so the peak memory is about one day of data regardless of the history length.
+    :param folder_path:
+    :param factor_list:
+    :param columns: only load these columns, None for all columns
+    :param files: only load these csv file names, None for all csv's in the folder
+    :return: ICAccumulator of all days, to be passed to performance_analysis.IC_quantile_streaming
+    """
+    # One store per product, the trading days of different products have the same names
+    store = None if config.factor_store is None else factor_store.FactorStore(os.path.join(config.factor_store, config.product))
+    accumulator = performance_analysis.ICAccumulator()
+    for l2 in iter_days(folder_path, columns=columns, files=files):
+        day = str(l2['TradingDay'].iloc[0])
+        with instrumentation.stage(day, category='day'):
+            factor = process_day(l2, factor_list, store=store)
+            accumulator.update(factor, label=day)
+    return accumulator
@@ -0,0 +1,101 @@
+import os
+import numpy as np
+import pandas as pd
+import session_calendar
+
+
+def generate_day(trading_day, product='ss', ticks_per_second=2, tick_size=5, start_price=15000,
+                 limit_probability=0.0005, seed=None):
+    """
+        Synthetic L2 snapshots of one trading day with the schema of the real csv's:
+        TradingDay, InstrumentID, UpdateTime, UpdateMillisec, ExchangeID, time_sec, temp2, LastPrice, Volume,
+        BidPrice1-5, BidVolume1-5, AskPrice1-5, AskVolume1-5, y_pos.
+        The mid price is a random walk on the tick grid over the night and day sessions of the product, y_pos is the
+        relative mid change 3-5 seconds later. Some ticks are at limit up/down (one side of the book is 0 / empty),
+        and Volume is sometimes missing.
+    :param trading_day: 'YYYY-MM-DD'
+    :param product: SHFE product code, for the sessions
+    :param ticks_per_second: number of snapshots per second (2 on SHFE)
+    :param tick_size:
+    :param start_price:
+    :param limit_probability: probability that a tick starts a limit up/down episode
+    :param seed: random seed
+    :return: dataframe
+    """
+    rng = np.random.default_rng(seed)
+    day = pd.Timestamp(trading_day)
+    # The night session belongs to the previous business day
+    night_day = pd.Timestamp(np.busday_offset(day.date(), -1, roll='backward'))
+
+    # Timestamps (ns since midnight of the session's calendar day) of every session
+    timestamps = []
+    step = session_calendar.NS_PER_SECOND // ticks_per_second
+    for start, end, _ in session_calendar.sessions(product):
+        start_ns, end_ns = session_calendar.to_ns(start), session_calendar.to_ns(end)
+        base = day.value
+        if start_ns >= 18 * 3600 * session_calendar.NS_PER_SECOND:
+            base = night_day.value
+            if end_ns <= start_ns:
+                end_ns += session_calendar.NS_PER_DAY
+        timestamps.append(base + np.arange(start_ns, end_ns, step))
+    index = pd.DatetimeIndex(np.concatenate(timestamps))
+    n = len(index)
+
+    # Mid price: random walk on the half-tick grid, spread of 1 tick (sometimes 2)
+    moves = rng.choice([-1, 0, 1], size=n, p=[0.03, 0.94, 0.03])
+    spread = np.where(rng.random(n) < 0.1, 2, 1) * tick_size
+    bid1 = start_price + tick_size * np.cumsum(moves)
+    ask1 = bid1 + spread
+    mid = (bid1 + ask1) / 2
+
+    data = {
+        'TradingDay': day.strftime('%Y-%m-%d'),
+        'InstrumentID': f'{product}{(day + pd.DateOffset(months=2)).strftime("%y%m")}',
+        'UpdateTime': index.strftime('%Y-%m-%d %H:%M:%S'),
+        'UpdateMillisec': (index.asi8 // 10 ** 6 % 1000).astype(np.int64),
+        'ExchangeID': 'SHFE',
+        'time_sec': session_calendar.time_of_day(index) / session_calendar.NS_PER_SECOND,
+        'temp2': 0,
+    }
+    data['LastPrice'] = np.where(rng.random(n) < 0.5, bid1, ask1).astype(np.float64)
+    volume = np.cumsum(rng.poisson(3, n)).astype(np.float64)
+    volume[rng.random(n) < 0.01] = np.nan
+    data['Volume'] = volume
+    for level in range(1, 6):
+        data[f'BidPrice{level}'] = (bid1 - tick_size * (level - 1)).astype(np.float64)
+        data[f'BidVolume{level}'] = rng.integers(1, 200, n).astype(np.float64)
+        data[f'AskPrice{level}'] = (ask1 + tick_size * (level - 1)).astype(np.float64)
+        data[f'AskVolume{level}'] = rng.integers(1, 200, n).astype(np.float64)
+    l2 = pd.DataFrame(data)
+
+    # Limit up (no ask) / limit down (no bid) episodes of a few seconds
+    for start in np.flatnonzero(rng.random(n) < limit_probability):
+        rows = slice(start, min(n, start + int(rng.integers(2, 20)) * ticks_per_second))
+        side = 'Ask' if rng.random() < 0.5 else 'Bid'
+        for level in range(1, 6):
+            l2.iloc[rows, l2.columns.get_loc(f'{side}Price{level}')] = 0
+            l2.iloc[rows, l2.columns.get_loc(f'{side}Volume{level}')] = np.nan
+
+    # y_pos: relative mid change 3-5 seconds later, within the same session (0 at the end of a session)
+    horizon = rng.integers(3 * ticks_per_second, 5 * ticks_per_second + 1, n)
+    target = np.minimum(np.arange(n) + horizon, n - 1)
+    session = session_calendar.session_ids(index, product)
+    l2['y_pos'] = np.where(session[target] == session, mid[target] / mid - 1, 0)
+    return l2
+
+
+def generate(folder_path, days=5, start='2023-03-01', product='ss', ticks_per_second=2, seed=0):
+    """
+        Write the csv's of `days` business days from `start` into folder_path, named like the real data (20230303.csv)
+    :return: list of the csv paths
+    """
+    if not os.path.exists(folder_path):
+        os.makedirs(folder_path)
+    paths = []
+    for i, day in enumerate(pd.bdate_range(start, periods=days)):
+        l2 = generate_day(day.strftime('%Y-%m-%d'), product=product, ticks_per_second=ticks_per_second,
+                          seed=None if seed is None else seed + i)
+        path = os.path.join(folder_path, f'{day.strftime("%Y%m%d")}.csv')
+        l2.to_csv(path, index=False)
+        paths.append(path)
+    return paths
@@ -0,0 +1,18 @@
+import os
+import sys
+import pytest
+
+# The modules of the repository are top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+
+@pytest.fixture
+def work_config(tmp_path, monkeypatch):
+    """
+        config with the parse cache and the factor store in tmp_path
+    """
+    monkeypatch.setattr(config, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(config, 'factor_store', str(tmp_path / 'factor_store'))
+    return config
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+import Data_Process
+import factors
+import synthetic_data
+
+
+@pytest.fixture
+def data(work_config, tmp_path):
+    folder_path = str(tmp_path / 'raw_data')
+    synthetic_data.generate(folder_path, days=3, ticks_per_second=1, seed=0)
+    return Data_Process.clean_l2_data(Data_Process.read_data(folder_path))
+
+
+def test_warmup_matches_full_history(work_config, data):
+    # Day by day with warm-up vs all the days at once: equal up to the rounding of the running sums
+    values = factors.compute_alpha(data, work_config.factor_list, n_jobs=1)
+    ctx = factors.FactorContext(data)
+    for name in work_config.factor_list:
+        full = np.asarray(factors.FACTORS[name].compute(ctx), dtype=np.float64)
+        np.testing.assert_allclose(values[name], full, rtol=0, atol=1e-9, equal_nan=True)
+
+
+def test_parallel_is_bit_identical(work_config, data):
+    serial = factors.compute_alpha(data, work_config.factor_list, n_jobs=1)
+    parallel = factors.compute_alpha(data, work_config.factor_list, n_jobs=2)
+    for name in work_config.factor_list:
+        assert np.array_equal(serial[name], parallel[name], equal_nan=True), name
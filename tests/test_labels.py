@@ -0,0 +1,22 @@
+import numpy as np
+import Data_Process
+import labels
+import synthetic_data
+
+
+def test_no_label_on_limit_ticks(work_config, tmp_path):
+    folder_path = str(tmp_path / 'raw_data')
+    # Frequent limit up/down episodes (one side of the book at 0)
+    l2 = synthetic_data.generate_day('2023-03-01', ticks_per_second=1, limit_probability=0.005, seed=0)
+    (tmp_path / 'raw_data').mkdir()
+    l2.to_csv(tmp_path / 'raw_data' / '20230301.csv', index=False)
+    data = Data_Process.clean_l2_data(Data_Process.read_data(folder_path))
+    limit = ((data['BidPrice1'] <= 0) | (data['AskPrice1'] <= 0)).to_numpy()
+    assert limit.any()
+
+    for unit, horizons in (('seconds', [1, 5, 30]), ('ticks', [1, 10])):
+        returns = labels.forward_returns(data, horizons, unit=unit, product='ss')
+        values = returns.to_numpy()
+        assert np.isnan(values[limit]).all()
+        # The mid moves by a few ticks over these horizons, far from the +-5000 bp of a half price
+        assert np.nanmax(np.abs(values)) < 1000
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import online_factors
+import synthetic_data
+
+
+@pytest.mark.parametrize('factor_warmup', [True, False])
+def test_parity_synthetic_days(work_config, tmp_path, monkeypatch, factor_warmup):
+    # Two days, with limit up/down episodes (empty side of the book) and missing volumes
+    monkeypatch.setattr(work_config, 'factor_warmup', factor_warmup)
+    folder_path = str(tmp_path / 'raw_data')
+    synthetic_data.generate(folder_path, days=2, ticks_per_second=1, seed=0)
+    parity = online_factors.check_parity(folder_path, work_config.factor_list)
+    assert (parity['mismatches'] == 0).all(), parity
+
+
+def test_parity_zero_and_missing_volumes(work_config, tmp_path):
+    folder_path = tmp_path / 'raw_data'
+    folder_path.mkdir()
+    l2 = synthetic_data.generate_day('2023-03-01', ticks_per_second=1, seed=1)
+    rng = np.random.default_rng(1)
+    # Zero depth at the best levels, on one side and on both sides, and runs of missing Volume
+    rows = rng.choice(len(l2), size=len(l2) // 50, replace=False)
+    l2.loc[rows[::2], 'BidVolume1'] = 0
+    l2.loc[rows[1::2], 'AskVolume1'] = 0
+    l2.loc[rows[::3], ['BidVolume1', 'AskVolume1']] = 0
+    l2.loc[1000:1200, 'Volume'] = np.nan
+    l2.to_csv(folder_path / '20230301.csv', index=False)
+    parity = online_factors.check_parity(str(folder_path), work_config.factor_list)
+    assert (parity['mismatches'] == 0).all(), parity
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import session_calendar
+from session_calendar import NS_PER_DAY, NS_PER_SECOND
+
+
+def brute_force(tod, intervals):
+    # Membership in the closed intervals, also shifted by one day for the ones crossing midnight
+    inside = np.zeros(len(tod), dtype=bool)
+    for start, end in intervals:
+        for shift in (0, NS_PER_DAY):
+            inside |= (tod + shift >= start) & (tod + shift <= end)
+    return inside
+
+
+@pytest.mark.parametrize('product', ['ss', 'au', 'rb', 'wr'])
+@pytest.mark.parametrize('open_seconds', [0, 600, 20000, 90000])
+def test_opening_boundaries_overlapping(product, open_seconds):
+    boundaries = session_calendar.opening_boundaries(product, open_seconds)
+    assert (np.diff(boundaries) > 0).all()
+    intervals = [(session_calendar.to_ns(start), session_calendar.to_ns(start) + open_seconds * NS_PER_SECOND)
+                 for start, _, is_opening in session_calendar.sessions(product) if is_opening]
+    tod = np.arange(0, NS_PER_DAY, 7 * NS_PER_SECOND + 1, dtype=np.int64)
+    expected = brute_force(tod, intervals)
+    assert np.array_equal(session_calendar.in_intervals(tod, boundaries), expected)
+
+
+def test_touching_intervals_merge():
+    boundaries = session_calendar.compile_intervals([(10, 19), (20, 30), (25, 40)])
+    assert boundaries.tolist() == [10, 41]